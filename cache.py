@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+
+'''a process wide cache of compiled patterns'''
+
+from collections import OrderedDict
+from threading import Event, RLock
+import os
+import sys
+
+
+class PatternCache:
+  '''a cache of compiled patterns keyed by the pattern and the options used to
+  compile it. once it holds @size patterns the least recently used pattern is
+  evicted to make room for a new one, and its native code is freed once 
+  nothing else is using it. it can be shared between threads, each pattern 
+  is only compiled once'''
+  def __init__(self, size=1000, directory=None):
+    self.size = size
+    self.lock = RLock()
+    # compiled patterns shared between processes through the filesystem
+    self.disk = None
+    if directory is not None:
+      self.disk = DiskCache(directory)
+    # key -> compiled pattern, in order from least to most recently used
+    self.entries = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def compile(self, pattern, level=2, **flags):
+    '''the compiled form of @pattern, optimized at @level (0 for no 
+    optimization), compiling it only if it isn't cached. @flags are passed
+    to NFA.fnmatch. patterns are compiled without holding the cache's lock,
+    so other patterns can be looked up meanwhile, and threads that want a
+    pattern that's being compiled wait for it'''
+    key = (pattern, level, tuple(sorted(flags.items())))
+    with self.lock:
+      if key in self.entries:
+        self.hits += 1
+        # move it to the most recently used end
+        entry = self.entries.pop(key)
+        building = False
+      else:
+        self.misses += 1
+        entry = Entry()
+        building = True
+        while len(self.entries) >= self.size:
+          self.entries.popitem(last=False)
+          self.evictions += 1
+      self.entries[key] = entry
+    if building:
+      try:
+        entry.compiled = self.build(pattern, level, flags)
+      except:
+        # let the next caller try again
+        entry.error = sys.exc_info()
+        with self.lock:
+          if self.entries.get(key) is entry:
+            del self.entries[key]
+      entry.ready.set()
+    return entry.result()
+
+  def build(self, pattern, level, flags):
+    '''compile @pattern, or load it from the disk cache'''
+    if self.disk is not None:
+      compiled = self.disk.load(pattern, level, flags)
+      if compiled is not None:
+        return compiled
+    from nfa import NFA
+    from dfa import DFA
+    from compiler import Compiled
+    compiled = Compiled(DFA(NFA.fnmatch(pattern, **flags), minimize=True))
+    if level:
+      compiled.optimize(level)
+    if self.disk is not None:
+      self.disk.store(pattern, level, flags, compiled)
+    return compiled
+
+  def __len__(self):
+    '''the number of cached patterns'''
+    return len(self.entries)
+
+  def clear(self):
+    '''empty the cache and reset its counters'''
+    with self.lock:
+      self.entries.clear()
+      self.hits = 0
+      self.misses = 0
+      self.evictions = 0
+
+  def stats(self):
+    '''a dict of the cache's counters'''
+    return {
+      'size': len(self.entries),
+      'capacity': self.size,
+      'hits': self.hits,
+      'misses': self.misses,
+      'evictions': self.evictions,
+    }
+
+
+class Entry:
+  '''a pattern in a PatternCache, which might still be being compiled'''
+  def __init__(self):
+    self.ready = Event()
+    self.compiled = None
+    # the exc_info() of the exception raised compiling the pattern
+    self.error = None
+
+  def result(self):
+    '''the compiled pattern, waiting until it's been compiled'''
+    self.ready.wait()
+    if self.error is not None:
+      raise self.error[0], self.error[1], self.error[2]
+    return self.compiled
+
+
+class DiskCache:
+  '''a directory of compiled patterns stored as optimized bitcode, so that
+  new processes don't have to compile patterns that other processes already
+  have. files are keyed by a hash of the pattern, the options used to compile
+  it and the versions of the compiler and LLVM, and are written atomically so
+  processes can safely share the directory. files that can't be loaded are
+  treated as missing, and replaced once the pattern's been compiled'''
+  def __init__(self, directory):
+    self.directory = directory
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+
+  def path(self, pattern, level, flags={}):
+    '''the file that the compiled form of @pattern is stored in'''
+    from hashlib import sha1
+    from compiler import VERSION, LLVM_VERSION
+    options = ','.join(['%s=%d' % item for item in sorted(flags.items())])
+    key = '%d\0%s\0%d\0%s\0%s' % (VERSION, LLVM_VERSION, level, options, 
+        pattern)
+    return os.path.join(self.directory, sha1(key).hexdigest() + '.bc')
+
+  def read(self, path):
+    '''the contents of @path, or None if it doesn't exist'''
+    try:
+      f = open(path, 'rb')
+    except IOError:
+      return None
+    try:
+      return f.read()
+    finally:
+      f.close()
+
+  def write(self, path, data):
+    '''atomically replace the contents of @path with @data'''
+    from tempfile import mkstemp
+    # write to a temporary file in the same directory then rename it over
+    # the destination, so readers only ever see complete files
+    fd, temp = mkstemp(dir=self.directory, suffix='.tmp')
+    try:
+      f = os.fdopen(fd, 'wb')
+      try:
+        f.write(data)
+      finally:
+        f.close()
+      os.rename(temp, path)
+    except:
+      os.unlink(temp)
+      raise
+
+  def load(self, pattern, level, flags={}):
+    '''the compiled form of @pattern, or None if it isn't in the cache or 
+    can't be loaded'''
+    from StringIO import StringIO
+    from compiler import Compiled
+    data = self.read(self.path(pattern, level, flags))
+    if data is None:
+      return None
+    try:
+      return Compiled(bitcode=StringIO(data))
+    except Exception:
+      # a damaged file, or bitcode this LLVM can't read
+      return None
+
+  def store(self, pattern, level, flags, compiled):
+    '''save the compiled form of @pattern'''
+    from StringIO import StringIO
+    bitcode = StringIO()
+    compiled.to_bitcode(bitcode)
+    self.write(self.path(pattern, level, flags), bitcode.getvalue())
+
+
+# the process wide cache
+cache = PatternCache()
+
+def compile(pattern, level=2, **flags):
+  '''the compiled form of @pattern from the process wide cache'''
+  return cache.compile(pattern, level, **flags)
+
+def use_directory(directory):
+  '''share compiled patterns with other processes through @directory'''
+  cache.disk = DiskCache(directory)
+
+
+def test_PatternCache():
+  class TestCache(PatternCache):
+    def build(self, pattern, level, flags):
+      return (pattern, level, self.misses)
+
+  cache = TestCache(size=2)
+  assert cache.compile('*.txt') == ('*.txt', 2, 1)
+  assert cache.compile('*.txt') == ('*.txt', 2, 1)
+  assert cache.compile('*.txt', level=0) == ('*.txt', 0, 2)
+  assert (cache.hits, cache.misses, cache.evictions) == (1, 2, 0)
+  # '*.txt' at level 2 is the least recently used, so it's evicted
+  assert cache.compile('README') == ('README', 2, 3)
+  assert (cache.hits, cache.misses, cache.evictions) == (1, 3, 1)
+  assert len(cache) == 2
+  assert cache.compile('*.txt') == ('*.txt', 2, 4)
+  # 'README' is now more recently used than '*.txt' so it survives
+  assert cache.compile('README') == ('README', 2, 3)
+  assert cache.compile('*.c') == ('*.c', 2, 5)
+  assert cache.compile('README') == ('README', 2, 3)
+  assert cache.stats() == {'size': 2, 'capacity': 2, 'hits': 3, 'misses': 5,
+      'evictions': 3}
+  # patterns compiled with different flags are cached separately
+  assert cache.compile('*.c', pathname=True) == ('*.c', 2, 6)
+  assert cache.compile('*.c', pathname=True) == ('*.c', 2, 6)
+  # and evicted separately, '*.c' without flags was the least recently used
+  assert cache.compile('*.c') == ('*.c', 2, 7)
+  cache.clear()
+  assert len(cache) == 0 and cache.stats()['hits'] == 0
+
+  # hits don't wait for other patterns to be compiled, requests for a
+  # pattern that's being compiled wait for it
+  from threading import Thread
+  started = Event()
+  release = Event()
+  class SlowCache(PatternCache):
+    def build(self, pattern, level, flags):
+      if pattern == 'slow':
+        started.set()
+        release.wait()
+      if pattern == 'broken':
+        raise ValueError(pattern)
+      return pattern
+  cache = SlowCache()
+  results = []
+  def compile(pattern):
+    results.append(cache.compile(pattern))
+  cache.compile('fast')
+  slow = Thread(target=compile, args=('slow',))
+  slow.start()
+  started.wait()
+  fast = Thread(target=compile, args=('fast',))
+  fast.start()
+  fast.join(10)
+  assert not fast.is_alive() and results == ['fast']
+  waiting = Thread(target=compile, args=('slow',))
+  waiting.start()
+  release.set()
+  slow.join()
+  waiting.join()
+  assert results == ['fast', 'slow', 'slow']
+  assert (cache.hits, cache.misses) == (2, 2)
+
+  # failures aren't cached
+  for attempt in range(2):
+    try:
+      cache.compile('broken')
+    except ValueError:
+      pass
+    else:
+      assert False
+  assert cache.misses == 4 and len(cache) == 2
+
+
+def test_DiskCache():
+  from tempfile import mkdtemp
+  from shutil import rmtree
+  directory = mkdtemp()
+  try:
+    disk = DiskCache(os.path.join(directory, 'cache'))
+    path = disk.path('*.txt', 2)
+    assert path != disk.path('*.txt', 0)
+    assert path != disk.path('*.c', 2)
+    assert path != disk.path('*.txt', 2, {'pathname': True})
+    assert path == disk.path('*.txt', 2, {})
+    assert disk.read(path) is None
+    disk.write(path, 'bitcode')
+    assert disk.read(path) == 'bitcode'
+    disk.write(path, 'new bitcode')
+    assert disk.read(path) == 'new bitcode'
+    # no temporary files are left behind
+    assert os.listdir(disk.directory) == [os.path.basename(path)]
+  finally:
+    rmtree(directory)
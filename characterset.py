@@ -1,3 +1,21 @@
+# the universe of characters is the 256 possible octets, so a set of
+# characters is represented as a 256-bit integer with bit n set if chr(n) is
+# in the set
+ALL_BITS = (1 << 256) - 1
+
+# the ASCII letters, lower case letters are 32 bits above upper case ones
+UPPER_BITS = ((1 << 26) - 1) << ord('A')
+LOWER_BITS = ((1 << 26) - 1) << ord('a')
+
+
+def bits(characters):
+  '''the bitset representation of an iterable of characters'''
+  result = 0
+  for c in characters:
+    result |= 1 << ord(c)
+  return result
+
+
 class CharacterSet:
   '''represents a set of characters, defined either by what is included in the
   set or by what is excluded from the set'''
@@ -6,7 +24,18 @@ class CharacterSet:
     '''call CharacterSet.including(), CharacterSet.excluding() or
     CharacterSet.range() instead of this'''
     self.inclusive = bool(inclusive)
-    self.characters = frozenset(characters)
+    if self.inclusive:
+      self.bits = bits(characters)
+    else:
+      self.bits = ALL_BITS & ~bits(characters)
+
+  @classmethod
+  def from_bits(klass, inclusive, bits):
+    '''construct a new CharacterSet directly from its bitset. @inclusive only
+    controls how the set is presented, it doesn't affect its contents'''
+    charset = klass(inclusive, '')
+    charset.bits = bits & ALL_BITS
+    return charset
 
   @classmethod
   def including(klass, characters):
@@ -27,16 +56,25 @@ class CharacterSet:
     
     if end < start:
       start, end = end, start
-    return klass(True, [chr(c) for c in range(ord(start), ord(end)+1)])
+    start, end = ord(start), ord(end)
+    return klass.from_bits(True, ((1 << (end-start+1)) - 1) << start)
 
-  def __contains__(self, c):
-    '''is the supplied character in the set?'''
-    assert isinstance(c, basestring) and len(c) == 1
-    
+  @property
+  def characters(self):
+    '''the characters included in (or excluded from) the set'''
     if self.inclusive:
-      return c in self.characters
+      bits = self.bits
     else:
-      return not (c in self.characters)
+      bits = ALL_BITS & ~self.bits
+    return frozenset([chr(c) for c in range(256) if (bits >> c) & 1])
+
+  def __contains__(self, c):
+    '''is the supplied character in the set?'''
+    return (self.bits >> ord(c)) & 1 == 1
+
+  def __len__(self):
+    '''the number of characters in the set'''
+    return bin(self.bits).count('1')
 
   def __str__(self):
     '''when displaying this set to the user, how should we present it?'''
@@ -51,68 +89,102 @@ class CharacterSet:
       
   def __eq__(self, other):
     assert isinstance(other, CharacterSet)
-    return self.inclusive == other.inclusive and \
-        self.characters == other.characters
+    return self.bits == other.bits
   def __ne__(self, other):
     assert isinstance(other, CharacterSet)
-    return not (self == other)
+    return self.bits != other.bits
   def __hash__(self):
-    return hash('%s %s' % (self.inclusive, ''.join(self.characters)))
+    return hash(self.bits)
 
   def union(self, other):
     '''set union'''
     assert isinstance(other, CharacterSet)
-    
-    if self.inclusive and other.inclusive:
-      return CharacterSet.including(self.characters.union(other.characters))
-    elif not self.inclusive and not other.inclusive:
-      return CharacterSet.excluding(self.characters.intersection(other.characters))
-    elif self.inclusive:
-      return CharacterSet.excluding(other.characters-self.characters)
-    else:
-      return CharacterSet.excluding(self.characters-other.characters)
+    return CharacterSet.from_bits(self.inclusive and other.inclusive,
+        self.bits | other.bits)
 
   def __sub__(self, other):
     '''set difference'''
     assert isinstance(other, CharacterSet)
-    
-    if self.inclusive and other.inclusive:
-      return CharacterSet.including(self.characters-other.characters)
-    elif not self.inclusive and not other.inclusive:
-      return CharacterSet.including(other.characters-self.characters)
-    elif self.inclusive and not other.inclusive:
-      return CharacterSet.including(self.characters.intersection(other.characters))
-    elif not self.inclusive and other.inclusive:
-      return CharacterSet.excluding(self.characters.union(other.characters))
-    else:
-      raise 'wtf?'
+    return CharacterSet.from_bits(self.inclusive or not other.inclusive,
+        self.bits & ~other.bits)
 
   def intersection(self, other):
     '''set intersection'''
     assert isinstance(other, CharacterSet)
-    
-    return self - (self - other)
+    return CharacterSet.from_bits(self.inclusive or other.inclusive,
+        self.bits & other.bits)
 
   def all(self):
     '''does the set match all characters?'''
-    return not self.inclusive and not self.characters
+    return self.bits == ALL_BITS
 
   def empty(self):
     '''does the set match no characters?'''
-    return self.inclusive and not self.characters
+    return self.bits == 0
 
   def __repr__(self):
-    return 'CharacterSet(%s, %s)' % (`self.inclusive`, `''.join(self.characters)`)
+    return 'CharacterSet(%s, %s)' % (`self.inclusive`, `''.join(sorted(self.characters))`)
+
+  def casefold(self):
+    '''the set widened to include both cases of every ASCII letter in it'''
+    return CharacterSet.from_bits(self.inclusive, self.bits |
+        (self.bits & UPPER_BITS) << 32 | (self.bits & LOWER_BITS) >> 32)
 
   def disjoint(self, other):
     '''does the set not intersect the other?'''
     assert isinstance(other, CharacterSet)
-    return (self.intersection(other)).empty()
+    return self.bits & other.bits == 0
     
   def intersects(self, other):
     '''does the set intersect another?'''
     assert isinstance(other, CharacterSet)
-    return not self.disjoint(other)
+    return self.bits & other.bits != 0
+
+
+class ByteClasses:
+  '''a partition of the 256 octets into equivalence classes such that none of
+  the CharacterSets it was built from can tell two octets in the same class
+  apart. octets map to small integer class ids.'''
+
+  def __init__(self, charsets):
+    # refine the partition with each distinct charset in turn
+    classes = [ALL_BITS]
+    for charset in frozenset(charsets):
+      refined = []
+      for cls in classes:
+        for part in (cls & charset.bits, cls & ~charset.bits):
+          if part: refined.append(part)
+      classes = refined
+    # number the classes in order of their lowest octet
+    classes.sort(key=lambda cls: cls & -cls)
+
+    # the character set for each class id
+    self.charsets = [CharacterSet.from_bits(bin(cls).count('1') <= 128, cls)
+        for cls in classes]
+    # a map from octet to class id
+    self.map = bytearray(256)
+    for id, cls in enumerate(classes):
+      for c in range(256):
+        if (cls >> c) & 1:
+          self.map[c] = id
+    # cache of charset -> class ids
+    self.__ids = {}
+
+  def __len__(self):
+    '''the number of classes'''
+    return len(self.charsets)
+
+  def __getitem__(self, c):
+    '''the class id of the character @c'''
+    return self.map[ord(c)]
+
+  def ids(self, charset):
+    '''the class ids that together make up @charset, which must be one of the
+    charsets (or a union of them) that the partition was built from'''
+    if not self.__ids.has_key(charset):
+      self.__ids[charset] = tuple([id for id, cls in enumerate(self.charsets)
+        if cls.bits & charset.bits])
+    return self.__ids[charset]
 
 
 def __disjoin(charsets, charset):
@@ -227,6 +299,27 @@ def test_CharacterSet():
   assert CharacterSet.excluding('').intersection(CharacterSet.including('')) == CharacterSet.including('')
   assert CharacterSet.including('').intersection(CharacterSet.excluding('')) == CharacterSet.including('')
 
+  # test case folding
+  assert CharacterSet.including('aB1').casefold() == CharacterSet.including('aAbB1')
+  assert CharacterSet.range('A', 'Z').casefold() == CharacterSet.range('a', 'z').union(CharacterSet.range('A', 'Z'))
+  assert CharacterSet.including('@[`{').casefold() == CharacterSet.including('@[`{')
+  assert CharacterSet.excluding('a').casefold() == CharacterSet.excluding('')
+  assert CharacterSet.including('\xe9').casefold() == CharacterSet.including('\xe9')
+
+  # test membership, size and canonical hashing of the bitset representation
+  assert 'a' in CharacterSet.including('ab')
+  assert 'c' not in CharacterSet.including('ab')
+  assert 'a' not in CharacterSet.excluding('ab')
+  assert '\xff' in CharacterSet.excluding('ab')
+  assert len(CharacterSet.including('ab')) == 2
+  assert len(CharacterSet.excluding('ab')) == 254
+  assert CharacterSet.range('a', 'z') == CharacterSet.range('z', 'a')
+  assert CharacterSet.range('a', 'c') == CharacterSet.including('cba')
+  assert CharacterSet.excluding('') == CharacterSet.including(map(chr, range(256)))
+  assert hash(CharacterSet.excluding('')) == hash(CharacterSet.including(map(chr, range(256))))
+  assert hash(CharacterSet.including('ab')) == hash(CharacterSet.including('ba'))
+  assert CharacterSet.excluding('ab').characters == frozenset('ab')
+
   # test all this disjoint set crap
   assert distinctCharacterSets([CharacterSet.including('')]) == set()
   assert distinctCharacterSets([CharacterSet.excluding('')]) == set([CharacterSet.excluding('')])
@@ -266,3 +359,27 @@ def test_CharacterSet():
       set([CharacterSet.including('a'), CharacterSet.including('b'), CharacterSet.including('c'), CharacterSet.including('de')])
 
 
+
+
+def test_ByteClasses():
+  # a single set that covers everything makes a single class
+  classes = ByteClasses([CharacterSet.excluding('')])
+  assert len(classes) == 1
+  assert classes['a'] == classes['\0'] == 0
+
+  # the classes for *.[ch]
+  classes = ByteClasses([CharacterSet.excluding(''), 
+    CharacterSet.including('.'), CharacterSet.including('ch')])
+  assert len(classes) == 3
+  assert classes['c'] == classes['h']
+  assert classes['.'] != classes['c']
+  assert classes['a'] != classes['c'] and classes['a'] != classes['.']
+  assert classes.ids(CharacterSet.including('ch')) == (classes['c'],)
+  assert len(classes.ids(CharacterSet.excluding(''))) == 3
+
+  # the classes partition the octets
+  union = CharacterSet.including('')
+  for charset in classes.charsets:
+    assert charset.disjoint(union)
+    union = union.union(charset)
+  assert union.all()
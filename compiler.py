@@ -5,133 +5,871 @@ from llvm.core import *
 from llvm.ee import *
 from llvm.passes import *
 
+# the version of the code generator, change it whenever the generated code
+# changes so that stale cached bitcode isn't used
+VERSION = 3
+
+def llvm_version():
+  '''a string identifying the LLVM bindings, and through them the LLVM
+  they're built against, since bitcode isn't portable between versions of
+  LLVM'''
+  import os
+  import llvm
+  version = str(getattr(llvm, '__version__', getattr(llvm, 'version', '')))
+  try:
+    from llvm import _core
+    info = os.stat(_core.__file__)
+  except (ImportError, AttributeError, OSError):
+    return version
+  # the bindings are rebuilt whenever LLVM is upgraded
+  return '%s:%d:%d' % (version, info.st_size, int(info.st_mtime))
+
+LLVM_VERSION = llvm_version()
+
+# the optimization passes run for each optimization level
+PASSES = {
+  0: (),
+  1: (PASS_PROMOTE_MEMORY_TO_REGISTER, PASS_INSTRUCTION_COMBINING,
+      PASS_CFG_SIMPLIFICATION),
+  2: (PASS_PROMOTE_MEMORY_TO_REGISTER, PASS_INSTRUCTION_COMBINING,
+      PASS_REASSOCIATE, PASS_SCCP, PASS_GVN, PASS_JUMP_THREADING,
+      PASS_CFG_SIMPLIFICATION, PASS_FUNCTION_INLINING, 
+      PASS_INSTRUCTION_COMBINING, PASS_AGGRESSIVE_DCE, 
+      PASS_CFG_SIMPLIFICATION),
+  3: (PASS_PROMOTE_MEMORY_TO_REGISTER, PASS_SCALAR_REPL_AGGREGATES,
+      PASS_INSTRUCTION_COMBINING, PASS_REASSOCIATE, PASS_SCCP, PASS_GVN,
+      PASS_JUMP_THREADING, PASS_CFG_SIMPLIFICATION, PASS_FUNCTION_INLINING,
+      PASS_LICM, PASS_LOOP_UNSWITCH, PASS_IND_VAR_SIMPLIFY,
+      PASS_INSTRUCTION_COMBINING, PASS_GVN, PASS_DEAD_STORE_ELIMINATION,
+      PASS_AGGRESSIVE_DCE, PASS_CFG_SIMPLIFICATION),
+}
+
+from threading import RLock
+
+from ctypes import CFUNCTYPE, PYFUNCTYPE, Structure, c_bool, c_char_p, \
+    c_int, c_int32, c_int64, c_ssize_t, c_uint8, c_uint64, c_void_p, \
+    POINTER, byref, cast, create_string_buffer, py_object, pythonapi
+
+
+def synchronized(method):
+  '''decorate @method so that it holds Compiled.lock while it runs'''
+  def locked(*args, **kwargs):
+    with Compiled.lock:
+      return method(*args, **kwargs)
+  locked.__name__ = method.__name__
+  locked.__doc__ = method.__doc__
+  return locked
+
 
 class Compiled:
-  '''compiler for DFAs representing text patterns into native code'''
+  '''compiler for DFAs representing text patterns into native code.
+
+  LLVM isn't thread safe so everything that touches it - generating code, 
+  adding modules to the shared execution engine, optimizing, JIT compiling
+  and ExecutionEngine.run_function - holds Compiled.lock. the native code
+  itself is called through ctypes without the lock, and ctypes releases the
+  GIL for the duration of the call, so threads can match in parallel.
+  optimize() should be called before a compiled pattern is shared between
+  threads'''
   ee = None
-  def __init__(self, dfa, debug=False):
-    '''compile a DFA into native code via llvm'''
+  lock = RLock()
+  # the type that the generated function returns, and its ctypes equivalent
+  result_type = Type.int(1)
+  result_ctype = c_bool
+  # call the JIT compiled code directly through ctypes rather than through
+  # ExecutionEngine.run_function
+  use_native = True
+  # the types of the elements of the results array of @fnmatch_many
+  many_type = Type.int(8)
+  many_ctype = c_uint8
+  # the estimated cost of dispatching on a range of octets, and of a table
+  # lookup, relative to the cost of a switch case
+  range_cost = 2
+  table_cost = 16
+  # the number of modules in the execution engine
+  modules = 0
+  # the module provider that adds the module to the execution engine, None
+  # until it's been added and once it's been removed
+  __provider = None
+  @synchronized
+  def __init__(self, dfa=None, debug=False, bitcode=None):
+    '''compile a DFA into native code via llvm, or load code previously saved
+    with to_bitcode() from the file @bitcode'''
+
+    putchar = None
 
     # create the module
-    if debug:
+    if bitcode is not None:
+      self.module = Module.from_bitcode(bitcode)
+      # find the functions before adding the module to the execution engine,
+      # so that a module without them isn't added
+      self.__bind()
+      self.__attach()
+      return
+    elif debug:
       from StringIO import StringIO
       self.module = Module.from_assembly(StringIO(
         '''declare i32 @putchar(i32) nounwind'''))
       putchar = self.module.get_function_named('putchar')
     else:
       self.module = Module.new('fnmatch_compile')
+    self.__attach()
+
+    # lookup tables used by dispatch(), by their contents
+    self.__tables = {}
+    self.function = self.__compile_match(dfa, 'fnmatch', False, putchar)
+    self.sized = self.__compile_match(dfa, 'fnmatch_n', True)
+    self.__compile_many()
+    self.__bind()
+
+  def __attach(self):
+    '''add the module to the shared execution engine'''
     if not Compiled.ee:
-      Compiled.ee = ExecutionEngine.new(ModuleProvider.new(self.module))
+      # the engine gets an empty module of its own, so that every pattern's
+      # module can be removed from it
+      Compiled.ee = ExecutionEngine.new(ModuleProvider.new(
+        Module.new('fnmatch_engine')))
+    self.__provider = ModuleProvider.new(self.module)
+    Compiled.ee.add_module_provider(self.__provider)
+    Compiled.modules += 1
+
+  def dispose(self):
+    '''remove the module from the shared execution engine and free its 
+    native code. the compiled pattern can't be used afterwards. this happens
+    when a compiled pattern is garbage collected, so it only needs calling
+    to free the code sooner'''
+    with self.lock:
+      if self.__provider is None:
+        return
+      for function in self.module.functions:
+        if not function.is_declaration:
+          self.ee.free_machine_code_for(function)
+      if hasattr(self.ee, 'remove_module_provider'):
+        self.ee.remove_module_provider(self.__provider)
+      else:
+        # llvm-py without module providers
+        self.ee.remove_module(self.module)
+      self.__provider = None
+      Compiled.modules -= 1
+      self.forget()
+
+  def __del__(self):
+    self.dispose()
 
+  def forget(self):
+    '''forget the ctypes functions for the native code, subclasses that
+    keep their own should forget them too'''
+    self.__native = None
+    self.__many_native = None
+    self.__sized_native = None
+
+  def __bind(self):
+    '''look up the generated functions in the module, forgetting any native
+    code for them'''
+    self.function = self.module.get_function_named('fnmatch')
+    self.many = self.module.get_function_named('fnmatch_many')
+    self.sized = self.module.get_function_named('fnmatch_n')
+    self.forget()
+
+  def __compile_match(self, dfa, name, sized, putchar=None):
+    '''add a function @name that matches a path against @dfa. if @sized the
+    function is passed the length of the path and every octet in it is
+    matched:
+      <result_type> @name(i8* path, i64 length)
+    otherwise the path ends at its first NUL:
+      <result_type> @name(i8* path)
+    if @putchar is supplied the function prints each state name and 
+    character as it goes'''
     # character type
     char_type = Type.int(8)
     # string type (char*)
     string_type = Type.pointer(char_type)
-    # boolean type
-    bool_type = Type.int(1)
 
-    # create the function i1 @fnmatch(i8*)
-    self.function = self.module.add_function(
-        Type.function(bool_type, [string_type]), 'fnmatch');
-    self.function.args[0].name = 'path'
+    # create the function
+    if sized:
+      function = self.module.add_function(Type.function(self.result_type, 
+        [string_type, Type.int(64)]), name)
+      function.args[1].name = 'length'
+    else:
+      function = self.module.add_function(
+          Type.function(self.result_type, [string_type]), name)
+    function.args[0].name = 'path'
 
     # create an entry block for the function
-    function_entry = self.function.append_basic_block('function_entry')
+    function_entry = function.append_basic_block('function_entry')
     entry_bb = Builder.new(function_entry)
 
     # create a local variable to hold the character pointer
     path_ptr = entry_bb.alloca(string_type, 'path_ptr')
     # store the %path argument
-    entry_bb.store(self.function.args[0], path_ptr)
-
-    # create a block that returns true
-    return_true = self.function.append_basic_block('return_true')
-    Builder.new(return_true).ret(Constant.int(bool_type, 1))
+    entry_bb.store(function.args[0], path_ptr)
+    if sized:
+      # find the end of the path
+      path_end = entry_bb.gep(function.args[0], [function.args[1]])
 
     # create a block that returns false
-    return_false = self.function.append_basic_block('return_false')
-    Builder.new(return_false).ret(Constant.int(bool_type, 0))
+    return_false = function.append_basic_block('return_false')
+    Builder.new(return_false).ret(self.result(None))
 
-    # for each of the states in the NFA we create a BasicBlock
+    # for each of the states in the DFA we create a BasicBlock, and a block
+    # to go to when the path ends in that state
+    blocks = {}
+    ends = {}
     for state in dfa.states:
-      state.block = self.function.append_basic_block('state_'+state.name)
+      blocks[state] = function.append_basic_block('state_'+state.name)
+      # matching states get a block that returns their result
+      if state.match:
+        ends[state] = function.append_basic_block('accept_'+state.name)
+        Builder.new(ends[state]).ret(self.result(state))
+      else:
+        ends[state] = return_false
 
-    # for each of the states in the NFA we add some simple code to the basic
+    # for each of the states in the DFA we add some simple code to the basic
     # blocks
     for state in dfa.states:
-      bb = Builder.new(state.block)
+      bb = Builder.new(blocks[state])
       # load the path pointer
       path = bb.load(path_ptr, 'path')
+      if sized:
+        # check for the end of the path
+        more = function.append_basic_block('more_'+state.name)
+        bb.cbranch(bb.icmp(ICMP_EQ, path, path_end), ends[state], more)
+        bb = Builder.new(more)
       # load the character at the current point in the path
       path_char = bb.load(path, 'path_char')
       # increment the path pointer
-      path_int = bb.ptrtoint(path, Type.int(32))
-      path_int = bb.add(path_int, Constant.int(Type.int(32), 1))
-      path = bb.inttoptr(path_int, string_type)
+      path = bb.gep(path, [Constant.int(Type.int(32), 1)])
       bb.store(path, path_ptr)
 
-      if debug:
+      if putchar is not None:
         for c in state.name:
           bb.call(putchar, [Constant.int(Type.int(32), ord(c))])
         bb.call(putchar, [bb.zext(path_char, Type.int(32))])
         bb.call(putchar, [Constant.int(Type.int(32), ord('\n'))])
 
-      # we need to work out what goes in our big switch statement
-      # find the exclusive character set (if one exists)
-      exclusive = [(c, s) for (c, s) in state if not c.inclusive]
-      assert len(exclusive) <= 1 # zero or one only I think...
-      if len(exclusive): 
-        excluded_chars = exclusive[0][0].characters
-        else_block = exclusive[0][1].block
-      else: 
-        excluded_chars = set()
-        else_block = return_false
-
-      # build a big-ass switch statement
-      switch = bb.switch(path_char, else_block)
-
-      for charset, child in state:
-        if not charset.inclusive: continue # already handled
-        # add a case for each character
-        for c in charset.characters:
-          switch.add_case(Constant.int(char_type, ord(c)), child.block)
-        # remove the handled chars from the excluded chars
-        excluded_chars = excluded_chars - charset.characters
-      # if there are any excluded characters left over, return false for them
-      if excluded_chars:
-        for c in excluded_chars:
-          switch.add_case(Constant.int(char_type, ord(c)), return_false)
-
-      # handle end of string '\0'
-      if state.match:
-        # end of string in a match state -> return true
-        switch.add_case(Constant.int(char_type, 0), return_true)
-      else:
-        # end of string elsewhere -> return false
-        switch.add_case(Constant.int(char_type, 0), return_false)
+      # work out where each octet goes from here
+      targets = []
+      for c in range(256):
+        child = state.next[dfa.classes.map[c]]
+        if child is None:
+          targets.append(return_false)
+        else:
+          targets.append(blocks[child])
+      if not sized:
+        # handle end of string '\0'
+        targets[0] = ends[state]
+      self.dispatch(function, bb, path_char, targets)
 
     # branch from the entry to the initial state
-    entry_bb.branch(dfa.initial.block)
+    entry_bb.branch(blocks[dfa.initial])
+
+    return function
+
+  def dispatch(self, function, bb, char, targets):
+    '''finish the block being built by @bb with a branch to targets[c] for
+    the octet @char. octets that go to the most common target are handled by
+    default and the others by whichever of a switch with a case per octet,
+    a chain of range comparisons or a lookup table is cheapest'''
+    # the most common target is the default
+    counts = {}
+    for target in targets:
+      counts[target] = counts.get(target, 0) + 1
+    default = targets[0]
+    for target in targets:
+      if counts[target] > counts[default]:
+        default = target
+
+    # find the runs of octets that go to the same, non-default, target
+    ranges = []
+    for c, target in enumerate(targets):
+      if target is default: continue
+      if ranges and ranges[-1][1] == c-1 and ranges[-1][2] is target:
+        ranges[-1][1] = c
+      else:
+        ranges.append([c, c, target])
+
+    # estimate what each strategy costs
+    cases = len(targets) - counts[default]
+    distinct = len(counts) - 1
+    costs = [
+      (cases, self.__dispatch_switch),
+      (self.range_cost * len(ranges), self.__dispatch_ranges),
+      (self.table_cost + distinct, self.__dispatch_table),
+    ]
+    cost, strategy = costs[0]
+    for c, s in costs[1:]:
+      if c < cost:
+        cost, strategy = c, s
+    strategy(function, bb, char, targets, default, ranges)
+
+  def __dispatch_switch(self, function, bb, char, targets, default, ranges):
+    '''dispatch with a case for each octet'''
+    # build a big-ass switch statement
+    switch = bb.switch(char, default)
+    for c, target in enumerate(targets):
+      if target is not default:
+        switch.add_case(Constant.int(Type.int(8), c), target)
+
+  def __dispatch_ranges(self, function, bb, char, targets, default, ranges):
+    '''dispatch with a comparison for each range of octets'''
+    char_type = Type.int(8)
+    if not ranges:
+      bb.branch(default)
+    for n, (start, end, target) in enumerate(ranges):
+      if n == len(ranges)-1:
+        otherwise = default
+      else:
+        otherwise = function.append_basic_block('range')
+      if start == end:
+        test = bb.icmp(ICMP_EQ, char, Constant.int(char_type, start))
+      else:
+        # start <= char <= end as a single unsigned comparison
+        offset = bb.sub(char, Constant.int(char_type, start))
+        test = bb.icmp(ICMP_ULE, offset, Constant.int(char_type, end-start))
+      bb.cbranch(test, target, otherwise)
+      if otherwise is not default:
+        bb = Builder.new(otherwise)
+
+  def __dispatch_table(self, function, bb, char, targets, default, ranges):
+    '''dispatch by looking up the octet in a table of small integers, and
+    switching on those'''
+    # number the targets, the default is 0
+    numbers = {default: 0}
+    order = []
+    for target in targets:
+      if not numbers.has_key(target):
+        numbers[target] = len(numbers)
+        order.append(target)
+    table = self.__table(tuple([numbers[target] for target in targets]))
+    index = bb.load(bb.gep(table, [Constant.int(Type.int(32), 0), 
+      bb.zext(char, Type.int(32))]), 'index')
+    switch = bb.switch(index, default)
+    for target in order:
+      switch.add_case(Constant.int(Type.int(8), numbers[target]), target)
+
+  def __table(self, entries):
+    '''a global constant [256 x i8] array holding @entries, identical
+    tables are shared'''
+    if not self.__tables.has_key(entries):
+      char_type = Type.int(8)
+      table = self.module.add_global_variable(Type.array(char_type, 256),
+          'dispatch_%d' % len(self.__tables))
+      table.initializer = Constant.array(char_type, 
+          [Constant.int(char_type, entry) for entry in entries])
+      table.global_constant = True
+      table.linkage = LINKAGE_INTERNAL
+      self.__tables[entries] = table
+    return self.__tables[entries]
+
+  def __compile_many(self):
+    '''add a function that runs @fnmatch over @count NUL terminated paths
+    stored one after another in @paths, storing the results in @results:
+    void @fnmatch_many(i8* paths, i32 count, <many_type>* results)'''
+    string_type = Type.pointer(Type.int(8))
+    count_type = Type.int(32)
+    self.many = self.module.add_function(Type.function(Type.void(), 
+      [string_type, count_type, Type.pointer(self.many_type)]), 
+      'fnmatch_many')
+    paths, count, results = self.many.args
+    paths.name = 'paths'
+    count.name = 'count'
+    results.name = 'results'
+
+    entry = self.many.append_basic_block('entry')
+    test = self.many.append_basic_block('test')
+    match = self.many.append_basic_block('match')
+    skip = self.many.append_basic_block('skip')
+    next = self.many.append_basic_block('next')
+    exit = self.many.append_basic_block('exit')
+
+    # local variables for the current path and its index
+    bb = Builder.new(entry)
+    path_ptr = bb.alloca(string_type, 'path_ptr')
+    bb.store(paths, path_ptr)
+    index_ptr = bb.alloca(count_type, 'index_ptr')
+    bb.store(Constant.int(count_type, 0), index_ptr)
+    bb.branch(test)
+
+    # loop until we've done @count paths
+    bb = Builder.new(test)
+    index = bb.load(index_ptr, 'index')
+    bb.cbranch(bb.icmp(ICMP_ULT, index, count), match, exit)
+
+    # match the current path and store the result
+    bb = Builder.new(match)
+    result = bb.call(self.function, [bb.load(path_ptr, 'path')])
+    result = self.widen(bb, result)
+    bb.store(result, bb.gep(results, [index]))
+    bb.branch(skip)
+
+    # skip past the NUL terminator of the current path
+    bb = Builder.new(skip)
+    path = bb.load(path_ptr, 'path')
+    path_char = bb.load(path, 'path_char')
+    bb.store(bb.gep(path, [Constant.int(count_type, 1)]), path_ptr)
+    bb.cbranch(bb.icmp(ICMP_EQ, path_char, Constant.int(Type.int(8), 0)),
+        next, skip)
+
+    # move on to the next path
+    bb = Builder.new(next)
+    bb.store(bb.add(index, Constant.int(count_type, 1)), index_ptr)
+    bb.branch(test)
+
+    Builder.new(exit).ret_void()
+
+  def widen(self, builder, result):
+    '''convert a value returned by @fnmatch to @many_type'''
+    return builder.zext(result, self.many_type)
 
   def __str__(self):
     '''the LLVM assembly language representation of the function'''
     return str(self.module)
 
+  def result(self, state):
+    '''the value the generated function returns for a path that ends in the
+    matching state @state, or None for a path that doesn't match'''
+    return Constant.int(self.result_type, int(state is not None))
+
+  def value(self, retval):
+    '''convert the GenericValue returned by the function to a Python value'''
+    return (retval.as_int() != 0)
+
   def __call__(self, path):
     '''execute the compiled code'''
+    native = self.__native
+    if native is None:
+      native = self.__native = self.__native_function()
+    if native:
+      return native(path)
+    return self.run(path)
+
+  def __native_function(self):
+    '''a ctypes function for @fnmatch, or False if it can't be called
+    natively'''
+    if self.use_native:
+      try:
+        return self.native(self.function, self.result_ctype, c_char_p)
+      except AttributeError:
+        # this llvm-py can't give us pointers to functions
+        pass
+    return False
+
+  def strategy(self):
+    '''how paths are matched'''
+    return 'compiled'
+
+  @synchronized
+  def run(self, path):
+    '''execute the compiled code through the execution engine, this is much
+    slower than calling it natively'''
+    self.check()
     path_value = GenericValue.string(Type.pointer(Type.int(8)), path)
     retval = Compiled.ee.run_function(self.function, [path_value])
-    return (retval.as_int() != 0)
+    return self.value(retval)
 
-  def optimize(self, level=2):
-    '''run the bitcode though the LLVM opt program'''
-    # FIXME: really, we should call the llvm-py APIs, but this is easier
-    from subprocess import Popen, PIPE
-    opt = Popen(('opt', '-O%d' % level), stdin=PIPE, stdout=PIPE)
-    self.module.to_bitcode(opt.stdin)
-    opt.stdin.close()
-    self.module = Module.from_bitcode(opt.stdout)
-    self.function = self.module.get_function_named('fnmatch')
+  def check(self):
+    '''raise ValueError if the compiled pattern has been disposed of'''
+    if self.__provider is None:
+      raise ValueError('compiled pattern has been disposed of')
+
+  @synchronized
+  def native(self, function, restype, *argtypes):
+    '''a ctypes foreign function that calls the native code JIT compiled for
+    @function'''
+    self.check()
+    address = Compiled.ee.get_pointer_to_function(function)
+    return CFUNCTYPE(restype, *argtypes)(address)
+
+  def values(self, results):
+    '''convert the results array filled in by @fnmatch_many to a Python 
+    value'''
+    return bytearray(results)
+
+  def match_many(self, paths):
+    '''match each of @paths with a single native call. returns a bytearray
+    with a 1 for each path that matches and a 0 for each that doesn't. paths
+    that contain NULs are matched separately'''
+    paths = list(paths)
+    results = (self.many_ctype * len(paths))()
+    nuls = []
+    if paths:
+      native = self.__many_native
+      if native is None:
+        native = self.__many_native = self.native(self.many, None, 
+            c_char_p, c_int32, POINTER(self.many_ctype))
+      # pack the paths into one buffer, each followed by a NUL. paths with
+      # NULs in them would throw out the results of the paths after them,
+      # so empty paths stand in for them
+      nuls = [n for n, path in enumerate(paths) if '\0' in path]
+      packed = paths
+      if nuls:
+        packed = list(paths)
+        for n in nuls:
+          packed[n] = ''
+      buffer = create_string_buffer('\0'.join(packed))
+      native(buffer, len(paths), results)
+    values = self.values(results)
+    for n in nuls:
+      values[n] = self.match_buffer(paths[n])
+    return values
+
+  def match_buffer(self, buffer, start=0, end=None):
+    '''match the octets buffer[start:end], which may include NULs. strs and
+    buffers such as bytearrays, mmaps and memoryviews are matched in place,
+    see locate()'''
+    buffer, base, start, end = locate(buffer, start, end)
+    native = self.__sized_native
+    if native is None:
+      native = self.__sized_native = self.native(self.sized, 
+          self.result_ctype, c_void_p, c_int64)
+    return native(base + start, end - start)
+
+  @synchronized
+  def optimize(self, level=2, passes=None):
+    '''optimize the generated code in place with the passes in PASSES for
+    @level, or with the list of passes @passes. this should be done before
+    the code is first called, since the JIT won't recompile code it has
+    already generated'''
+    if passes is None:
+      passes = PASSES[level]
+    pm = PassManager.new()
+    for p in passes:
+      pm.add(p)
+    pm.run(self.module)
+    self.__bind()
+
+  @synchronized
+  def to_bitcode(self, f):
+    '''write the compiled code to the file @f as LLVM bitcode'''
+    self.module.to_bitcode(f)
+
+
+class Py_buffer(Structure):
+  '''the C API's description of an object's buffer'''
+  _fields_ = [('buf', c_void_p), ('obj', py_object), ('len', c_ssize_t),
+      ('itemsize', c_ssize_t), ('readonly', c_int), ('ndim', c_int),
+      ('format', c_char_p), ('shape', POINTER(c_ssize_t)),
+      ('strides', POINTER(c_ssize_t)), ('suboffsets', POINTER(c_ssize_t)),
+      ('smalltable', c_ssize_t * 2), ('internal', c_void_p)]
+
+# the buffer interfaces of the C API. the old interface is supported by strs,
+# bytearrays, buffers, arrays and mmaps, including read-only ones, and the
+# new one by memoryviews
+PyObject_AsReadBuffer = PYFUNCTYPE(c_int, py_object, POINTER(c_void_p),
+    POINTER(c_ssize_t))(('PyObject_AsReadBuffer', pythonapi))
+PyObject_GetBuffer = PYFUNCTYPE(c_int, py_object, POINTER(Py_buffer),
+    c_int)(('PyObject_GetBuffer', pythonapi))
+PyBuffer_Release = PYFUNCTYPE(None, POINTER(Py_buffer))(
+    ('PyBuffer_Release', pythonapi))
+PyBUF_SIMPLE = 0
+
+
+def buffer_address(buffer):
+  '''the address and length in octets of the contents of the str or buffer
+  @buffer, which stay valid as long as @buffer isn't resized or freed. raises
+  TypeError for objects that don't have contiguous contents'''
+  if isinstance(buffer, str):
+    return cast(c_char_p(buffer), c_void_p).value, len(buffer)
+  if isinstance(buffer, unicode):
+    # its buffer is the internal representation, not octets
+    raise TypeError('unicode has no octets')
+  address = c_void_p()
+  length = c_ssize_t()
+  try:
+    PyObject_AsReadBuffer(buffer, byref(address), byref(length))
+    return address.value or 0, length.value
+  except TypeError:
+    pass
+  # objects that only have the new buffer interface. the memoryview itself
+  # holds on to the buffer of the object it's a view of, so the view taken
+  # here can be released straight away
+  view = Py_buffer()
+  try:
+    PyObject_GetBuffer(buffer, byref(view), PyBUF_SIMPLE)
+  except (TypeError, BufferError, ValueError), e:
+    raise TypeError(str(e))
+  try:
+    return view.buf or 0, view.len
+  finally:
+    PyBuffer_Release(byref(view))
+
+
+def locate(buffer, start=0, end=None):
+  '''find the octets buffer[start:end] in memory. returns the buffer that
+  holds them, which must be kept alive while they're used, its address and
+  the start and end of the octets in it. strs, buffers such as mmaps and
+  bytearrays, whether they're writable or not, and contiguous memoryviews
+  are used in place, other objects are copied'''
+  try:
+    address, length = buffer_address(buffer)
+  except TypeError:
+    address, length = None, len(buffer)
+  if end is None:
+    end = length
+  if not 0 <= start <= end <= length:
+    raise IndexError('buffer slice out of range')
+  if address is not None:
+    return buffer, address, start, end
+  # there's nothing to point at, we can only use a copy
+  part = buffer[start:end]
+  if not isinstance(part, str):
+    part = bytearray(part)
+  address, length = buffer_address(part)
+  return part, address, 0, length
+
+
+class CompiledPatternSet(Compiled):
+  '''compiler for the DFA of a PatternSet. matching returns a bitmask of the
+  patterns that match, or the index of the first pattern that matches (-1 for
+  none) if @first is set. bitmasks can be wider than any integer type, so for
+  them the native function returns an index into @masks, a list of the 
+  distinct bitmasks of the DFA's states, and that's mapped to the bitmask'''
+  result_type = many_type = Type.int(32)
+  result_ctype = many_ctype = c_int32
+
+  def __init__(self, dfa, first=False, debug=False):
+    self.first = first
+    # the bitmasks, with 0 for no patterns matching first, and their indexes
+    self.masks = [0]
+    self.indexes = {0: 0}
+    for state in dfa.states:
+      mask = sum([1 << id for id in state.patterns])
+      if not self.indexes.has_key(mask):
+        self.indexes[mask] = len(self.masks)
+        self.masks.append(mask)
+    Compiled.__init__(self, dfa, debug)
+
+  def result(self, state):
+    if self.first:
+      if state is None: return Constant.int(self.result_type, -1)
+      return Constant.int(self.result_type, min(state.patterns))
+    if state is None: return Constant.int(self.result_type, 0)
+    return Constant.int(self.result_type, 
+        self.indexes[sum([1 << id for id in state.patterns])])
+
+  def value(self, retval):
+    if self.first:
+      return retval.as_int_signed()
+    return self.masks[retval.as_int()]
+
+  def widen(self, builder, result):
+    return result
+
+  def values(self, results):
+    if self.first:
+      return list(results)
+    masks = self.masks
+    return [masks[index] for index in results]
+
+  def native(self, function, restype, *argtypes):
+    native = Compiled.native(self, function, restype, *argtypes)
+    if restype is self.result_ctype and not self.first:
+      # map the index the native code returns to its bitmask
+      masks = self.masks
+      native.errcheck = lambda index, function, args: masks[index]
+    return native
+
+
+class CompiledLoop(Compiled):
+  '''base class for compilers that generate a loop over a buffer that can
+  start in any state of the DFA and stop part way through it. the states are
+  numbered so that the state can be carried from one call to the next.
+  subclasses add their function with loop() and say what it returns when it
+  stops with stop()'''
+  # whether the loop stops when it arrives in a matching state, as well as
+  # at the end of the buffer
+  stop_at_matches = False
+
+  def __init__(self, dfa, debug=False):
+    Compiled.__init__(self, dfa, debug)
+    with Compiled.lock:
+      # number the states
+      self.numbers = dict([(state, n) for n, state in enumerate(dfa.states)])
+      self.initial_state = self.numbers[dfa.initial]
+      self.accepting = frozenset([self.numbers[state] for state in dfa.states
+        if state.match])
+
+  def loop(self, function, entry_bb, dfa, buffer, length, position, state):
+    '''build the body of @function, whose entry block is being built by 
+    @entry_bb: starting at the i64 offset @position in @buffer in the DFA
+    state numbered by the i32 @state, consume octets until the offset 
+    @length'''
+    offset_type = Type.int(64)
+    state_type = Type.int(32)
+
+    # a local variable to hold the offset
+    offset_ptr = entry_bb.alloca(offset_type, 'offset_ptr')
+    entry_bb.store(position, offset_ptr)
+
+    # a block for when there's no transition
+    dead = function.append_basic_block('dead')
+    self.stop(function, Builder.new(dead), None, None)
+
+    # each state gets a block that consumes an octet, and if the loop stops
+    # at matches matching states get a block that stops on the way in
+    blocks = {}
+    arrivals = {}
+    for state in dfa.states:
+      blocks[state] = function.append_basic_block('state_'+state.name)
+      if state.match and self.stop_at_matches:
+        arrivals[state] = function.append_basic_block('arrive_'+state.name)
+        bb = Builder.new(arrivals[state])
+        self.stop(function, bb, state, bb.load(offset_ptr, 'offset'))
+      else:
+        arrivals[state] = blocks[state]
+
+    for state in dfa.states:
+      bb = Builder.new(blocks[state])
+      offset = bb.load(offset_ptr, 'offset')
+      # stop at the end of the buffer
+      more = function.append_basic_block('more_'+state.name)
+      end = function.append_basic_block('end_'+state.name)
+      bb.cbranch(bb.icmp(ICMP_EQ, offset, length), end, more)
+      self.stop(function, Builder.new(end), state, None)
+      # consume an octet
+      bb = Builder.new(more)
+      char = bb.load(bb.gep(buffer, [offset]), 'char')
+      bb.store(bb.add(offset, Constant.int(offset_type, 1)), offset_ptr)
+      targets = []
+      for c in range(256):
+        child = state.next[dfa.classes.map[c]]
+        if child is None:
+          targets.append(dead)
+        else:
+          targets.append(arrivals[child])
+      self.dispatch(function, bb, char, targets)
+
+    # start in the state we're passed
+    switch = entry_bb.switch(state, dead)
+    for state in dfa.states:
+      switch.add_case(Constant.int(state_type, self.numbers[state]), 
+          blocks[state])
+
+  def stop(self, function, bb, state, offset):
+    '''finish the block being built by @bb, which returns from @function
+    because the loop has stopped in @state: with @offset None at the end of
+    the buffer, otherwise at the i64 @offset just after arriving in a 
+    matching state. @state is None when there's no transition'''
+    raise NotImplementedError
+
+  def number(self, state):
+    '''the i32 number of @state, -1 for None'''
+    if state is None:
+      return Constant.int(Type.int(32), -1)
+    return Constant.int(Type.int(32), self.numbers[state])
+
+
+class CompiledSearch(CompiledLoop):
+  '''compiler for unanchored DFAs, see search.py. as well as the usual
+  functions it generates a scan loop that finds where matches end:
+    i64 @fnmatch_scan(i8* buffer, i64 length, i64 position, i32* state)
+  which starts at @position in the DFA state numbered *@state and returns
+  the offset just past the end of the next match, or -1 when it reaches
+  @length. the state it stops in is stored back in *@state, -1 if there
+  are no more matches possible'''
+  stop_at_matches = True
+
+  def __init__(self, dfa, debug=False):
+    CompiledLoop.__init__(self, dfa, debug)
+    with Compiled.lock:
+      self.scan_function = self.__compile_scan(dfa)
+      self.__scan_native = None
+
+  def __compile_scan(self, dfa):
+    '''add the @fnmatch_scan function'''
+    char_type = Type.int(8)
+    offset_type = Type.int(64)
+    state_type = Type.int(32)
+    function = self.module.add_function(Type.function(offset_type, 
+      [Type.pointer(char_type), offset_type, offset_type, 
+        Type.pointer(state_type)]), 'fnmatch_scan')
+    buffer, length, position, state_ptr = function.args
+    buffer.name = 'buffer'
+    length.name = 'length'
+    position.name = 'position'
+    state_ptr.name = 'state_ptr'
+    function_entry = function.append_basic_block('function_entry')
+    entry_bb = Builder.new(function_entry)
+    self.loop(function, entry_bb, dfa, buffer, length, position,
+        entry_bb.load(state_ptr, 'state'))
+    return function
+
+  def stop(self, function, bb, state, offset):
+    # store the state and return the offset of the match, if there is one
+    bb.store(self.number(state), function.args[3])
+    if offset is None:
+      bb.ret(Constant.int(Type.int(64), -1))
+    else:
+      bb.ret(offset)
+
+  def forget(self):
+    Compiled.forget(self)
+    self.__scan_native = None
+
+  def scan(self, buffer, start=0, end=None):
+    '''yield the offsets in @buffer just past the ends of matches that end
+    in buffer[start:end], not including an empty match at @start'''
+    buffer, base, start, end = locate(buffer, start, end)
+    native = self.__scan_native
+    if native is None:
+      native = self.__scan_native = self.native(self.scan_function, c_int64, 
+          c_void_p, c_int64, c_int64, POINTER(c_int32))
+    state = c_int32(self.initial_state)
+    offset = start
+    while True:
+      offset = native(base, end, offset, byref(state))
+      if offset < 0:
+        return
+      yield offset
+
+
+class CompiledFeed(CompiledLoop):
+  '''compiler for matching input that arrives in chunks, see incremental.py.
+  as well as the usual functions it generates:
+    i32 @fnmatch_feed(i8* buffer, i64 length, i32 state)
+  which runs the DFA over the @length octets at @buffer starting in the state
+  numbered @state and returns the number of the state it ends in, or -1 if
+  it ran out of transitions. passing -1 back in returns -1'''
+  def __init__(self, dfa, debug=False):
+    CompiledLoop.__init__(self, dfa, debug)
+    with Compiled.lock:
+      self.feed_function = self.__compile_feed(dfa)
+      self.__feed_native = None
+
+  def __compile_feed(self, dfa):
+    '''add the @fnmatch_feed function'''
+    char_type = Type.int(8)
+    offset_type = Type.int(64)
+    state_type = Type.int(32)
+    function = self.module.add_function(Type.function(state_type, 
+      [Type.pointer(char_type), offset_type, state_type]), 'fnmatch_feed')
+    buffer, length, state = function.args
+    buffer.name = 'buffer'
+    length.name = 'length'
+    state.name = 'state'
+    function_entry = function.append_basic_block('function_entry')
+    self.loop(function, Builder.new(function_entry), dfa, buffer, length, 
+        Constant.int(offset_type, 0), state)
+    return function
+
+  def stop(self, function, bb, state, offset):
+    # return the state
+    bb.ret(self.number(state))
+
+  def forget(self):
+    Compiled.forget(self)
+    self.__feed_native = None
+
+  def feed(self, state, buffer, start=0, end=None):
+    '''the number of the state the DFA is in after running buffer[start:end]
+    from the state numbered @state, or -1 if it ran out of transitions. strs
+    and buffers are read in place, see locate()'''
+    buffer, base, start, end = locate(buffer, start, end)
+    native = self.__feed_native
+    if native is None:
+      native = self.__feed_native = self.native(self.feed_function, c_int32,
+          c_void_p, c_int64, c_int32)
+    return native(base + start, end - start, state)
 
 
 if __name__ == '__main__':
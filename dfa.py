@@ -3,59 +3,354 @@
 # character classes are functions f(c) -> True/False
 # states are functions f(c) -> set of states
 
-from characterset import CharacterSet, distinctCharacterSets
+from characterset import CharacterSet, ByteClasses, distinctCharacterSets
 from fsm import State, StateMachine
+from itertools import count
+from string import uppercase
+from threading import RLock
+from time import time
+
+def state_name(n):
+  '''the name of the @n'th DFA state: A to Z, then AA, AB and so on'''
+  name = ''
+  n += 1
+  while n:
+    n, letter = divmod(n - 1, len(uppercase))
+    name = uppercase[letter] + name
+  return name
+
+# numbers the DFA states. count() can be shared between threads, unlike a
+# generator
+state_numbers = count()
+
+def bits(mask):
+  '''the positions of the set bits of @mask, lowest first'''
+  while mask:
+    low = mask & -mask
+    yield low.bit_length() - 1
+    mask ^= low
+
+
+def reachable(initial):
+  '''the list of states reachable from @initial, including it'''
+  states = [initial]
+  seen = set(states)
+  work = [initial]
+  while work:
+    for charset, child in work.pop():
+      if child not in seen:
+        seen.add(child)
+        states.append(child)
+        work.append(child)
+  return states
 
-def name_generator():
-  from string import uppercase
-  from itertools import chain
-  for n in chain([''], name_generator()):
-    for c in uppercase:
-      yield n+c
-namegen = name_generator()
 
 class DFAState(State):
   def __init__(self, nfa_states):
     State.__init__(self, 
-        name=namegen.next(),
+        name=state_name(state_numbers.next()),
         description=','.join([nfa_state.name for nfa_state in nfa_states]),
         match=any([state.match for state in nfa_states]))
+    # the ids of the patterns this state matches, see patternset.py
+    self.patterns = frozenset().union(*[state.patterns 
+      for state in nfa_states if state.match])
+    # the next state for each byte class id, None where there's no transition
+    self.next = []
 
 
 class DFA(StateMachine):
-  def __init__(self, nfa):
-    # stores a map of states-key -> state while we build the DFA
+  def __init__(self, nfa, minimize=False):
+    start = time()
+    # number the reachable NFA states, so that sets of them can be bitmasks
+    nfa_states = reachable(nfa.initial)
+    numbers = dict([(state, n) for n, state in enumerate(nfa_states)])
+    # partition the octets into the classes that the NFA can distinguish
+    self.classes = ByteClasses([charset for state in nfa_states
+      for charset, child in state])
+    # for each NFA state, the mask of NFA states each byte class leads to
+    moves = []
+    for nfa_state in nfa_states:
+      move = [0] * len(self.classes)
+      for charset, child in nfa_state:
+        for cls in self.classes.ids(charset):
+          move[cls] |= 1 << numbers[child]
+      moves.append(move)
+
+    # stores a map of NFA states mask -> state while we build the DFA
     known_states = {}
-    initial = self.__processNFAState([nfa.initial], known_states)
-    StateMachine.__init__(self, initial, known_states.values())
-
-  def __processNFAState(self, nfa_states, known_states):
-    # look up to see if we've processed this set of NFA states into a DFA state yet
-    states_key = tuple([str(nfa_state.id) for nfa_state in nfa_states])
-    if known_states.has_key(states_key):
-      return known_states[states_key]
-    # nope, make a new one
-    dfa_state = DFAState(nfa_states)
-    # stash it in the hash table
-    known_states[states_key] = dfa_state
+    states = []
+    def state(mask):
+      '''the DFA state for a mask of NFA states, and whether it's new'''
+      if known_states.has_key(mask):
+        return known_states[mask], False
+      dfa_state = DFAState([nfa_states[n] for n in bits(mask)])
+      dfa_state.mask = mask
+      known_states[mask] = dfa_state
+      states.append(dfa_state)
+      return dfa_state, True
+
+    # work through the DFA states until we've found all of their children
+    initial, new = state(1 << numbers[nfa.initial])
+    work = [initial]
+    while work:
+      dfa_state = work.pop()
+      # find the mask of NFA states that each byte class leads to
+      targets = [0] * len(self.classes)
+      for n in bits(dfa_state.mask):
+        for cls, move in enumerate(moves[n]):
+          targets[cls] |= move
+      # find or make the DFA state for each of those masks
+      dfa_state.next = []
+      for mask in targets:
+        if not mask:
+          dfa_state.next.append(None)
+          continue
+        child, new = state(mask)
+        if new:
+          work.append(child)
+        dfa_state.next.append(child)
+      self.__link(dfa_state)
+
+    StateMachine.__init__(self, initial, states)
+    self.nfa_states = len(nfa_states)
+    self.__live = None
+    self.build_time = time() - start
+    if minimize:
+      self.minimize()
+
+  def stats(self):
+    '''a dict describing the DFA and how long it took to build'''
+    return {
+      'nfa_states': self.nfa_states,
+      'states': len(self.states),
+      'classes': len(self.classes),
+      'build_time': self.build_time,
+    }
 
-    # find all the arcs going out from the set of NFA nodes that this DFA node represents
+  def __link(self, dfa_state):
+    '''rebuild the arcs of @dfa_state from its per-class transitions, classes
+    that lead to the same state share an arc'''
     arcs = {}
-    for nfa_state in nfa_states:
-      for charset, child_state in nfa_state.children:
-        if not arcs.has_key(charset):
-          arcs[charset] = []
-        arcs[charset].append(child_state)
+    order = []
+    for cls, child in enumerate(dfa_state.next):
+      if child is None: continue
+      if arcs.has_key(child):
+        arcs[child] = arcs[child].union(self.classes.charsets[cls])
+      else:
+        arcs[child] = self.classes.charsets[cls]
+        order.append(child)
+    dfa_state.children = [(arcs[child], child) for child in order]
+
+  def minimize(self):
+    '''merge equivalent states, in place. states are split first by whether
+    they match and then by which blocks their transitions lead to until no
+    block can be split any further. returns the number of states before and
+    after minimization'''
+    before = len(self.states)
+
+    # the initial partition, by acceptance and the patterns that match
+    initial = {}
+    block = dict([(state, initial.setdefault((state.match, state.patterns), 
+      len(initial))) for state in self.states])
+    count = len(initial)
+    while True:
+      signatures = {}
+      refined = {}
+      for state in self.states:
+        signature = (block[state], tuple([child is None and -1 or block[child]
+            for child in state.next]))
+        refined[state] = signatures.setdefault(signature, len(signatures))
+      block = refined
+      if len(signatures) == count: break
+      count = len(signatures)
+
+    # pick a representative for each block, the initial state represents its
+    # own block
+    representatives = {block[self.initial]: self.initial}
+    for state in self.states:
+      representatives.setdefault(block[state], state)
+    states = [state for state in self.states 
+        if representatives[block[state]] is state]
+
+    # point the representatives' transitions at other representatives
+    for state in states:
+      state.next = [child and representatives[block[child]]
+          for child in state.next]
+      self.__link(state)
+    self.states = states
+    self.__live = None
+
+    return before, len(states)
+
+  def live(self):
+    '''the set of states that can still reach a matching state. any other
+    state is dead: once the DFA is in it no path can match'''
+    if self.__live is None:
+      # walk the transitions backwards from the matching states
+      parents = dict([(state, []) for state in self.states])
+      for state in self.states:
+        for child in state.next:
+          if child is not None:
+            parents[child].append(state)
+      live = set([state for state in self.states if state.match])
+      work = list(live)
+      while work:
+        for parent in parents[work.pop()]:
+          if parent not in live:
+            live.add(parent)
+            work.append(parent)
+      self.__live = frozenset(live)
+    return self.__live
+
+  def cursor(self):
+    '''a Cursor at the start of a path'''
+    return Cursor(self, self.initial)
+
+  def final(self, s, state=None):
+    '''the state that the DFA is in after processing @s starting from @state
+    (by default the initial state), or None if it ran out of transitions'''
+    classes = self.classes.map
+    if state is None:
+      state = self.initial
+    for c in s:
+      state = state.next[classes[ord(c)]]
+      if state is None:
+        # there's no transition so there's no match
+        return None
+    return state
+
+  def __call__(self, s):
+    '''evaluate a string against this DFA, return True or False'''
+    state = self.final(s)
+    return state is not None and state.match
+
+class Cursor:
+  '''a position part way through matching a path, so that a path can be fed
+  to the DFA a piece at a time. cursors are immutable: feeding one returns a
+  new cursor, so a directory's cursor can be fed each of its entries'''
+  def __init__(self, dfa, state):
+    self.dfa = dfa
+    self.state = state
 
-    # make the arcs "distinct"
-    arcs = distinctArcs(arcs)
+  def feed(self, s):
+    '''the cursor after processing @s'''
+    if self.state is None:
+      return self
+    return Cursor(self.dfa, self.dfa.final(s, self.state))
 
-    for charset, child_nfa_states in arcs.items():
-      dfa_state.add(charset, 
-        self.__processNFAState(child_nfa_states, known_states))
+  def dead(self):
+    '''can no path that starts with what's been fed match?'''
+    return self.state is None or self.state not in self.dfa.live()
 
+  def match(self):
+    '''does what's been fed so far match?'''
+    return self.state is not None and self.state.match
+
+
+# marks a transition that the lazy DFA hasn't worked out yet
+UNKNOWN = object()
+
+class LazyDFA:
+  '''a DFA that is determinized on demand: a state's transition for a byte
+  class is only worked out when input first takes it. the determinized 
+  states are cached, and the cache is flushed whenever it grows past
+  @max_states, so memory use and build time are bounded however many states
+  the full DFA would have. @max_states counts the initial state, which is
+  always cached, so it must be at least 2. it can be shared between 
+  threads: determinizing holds a lock, following transitions that are 
+  already known doesn't'''
+  def __init__(self, nfa, max_states=1000):
+    assert max_states >= 2
+    self.nfa = nfa
+    self.max_states = max_states
+    # partition the octets into the classes that the NFA can distinguish
+    self.classes = ByteClasses([charset for state in nfa 
+      for charset, child in state])
+    # the arcs of each NFA state, as sets of class ids
+    self.arcs = {}
+    for state in nfa:
+      self.arcs[state] = [(frozenset(self.classes.ids(charset)), child)
+          for charset, child in state]
+    # frozenset of NFA states -> DFA state
+    self.cache = {}
+    self.flushes = 0
+    # guards the cache and the transitions being worked out
+    self.lock = RLock()
+    self.initial = self.__state(frozenset([nfa.initial]))
+
+  def __state(self, nfa_states):
+    '''the DFA state for a set of NFA states, creating it if it's not in the
+    cache'''
+    if self.cache.has_key(nfa_states):
+      return self.cache[nfa_states]
+    if len(self.cache) >= self.max_states:
+      self.flush()
+    dfa_state = DFAState(nfa_states)
+    dfa_state.nfa_states = nfa_states
+    dfa_state.next = [UNKNOWN] * len(self.classes)
+    self.cache[nfa_states] = dfa_state
     return dfa_state
 
+  def __step(self, dfa_state, cls):
+    '''work out the transition from @dfa_state for the byte class @cls'''
+    with self.lock:
+      # another thread might have got here first
+      child = dfa_state.next[cls]
+      if child is not UNKNOWN:
+        return child
+      targets = frozenset([child for nfa_state in dfa_state.nfa_states
+          for ids, child in self.arcs[nfa_state] if cls in ids])
+      if targets:
+        child = self.__state(targets)
+      else:
+        child = None
+      dfa_state.next[cls] = child
+      return child
+
+  def flush(self):
+    '''empty the cache of determinized states. states already in use stay
+    valid but aren't shared with states created later'''
+    with self.lock:
+      self.cache = {}
+      self.flushes += 1
+      self.initial = self.__state(frozenset([self.nfa.initial]))
+
+  def __len__(self):
+    '''the number of cached states'''
+    return len(self.cache)
+
+  def __iter__(self):
+    '''return an iterator for the cached states'''
+    return iter(self.cache.values())
+
+  def strategy(self):
+    '''how paths are matched'''
+    return 'lazy-dfa'
+
+  def stats(self):
+    '''a dict describing the state cache'''
+    return {
+      'states': len(self.cache),
+      'max_states': self.max_states,
+      'flushes': self.flushes,
+    }
+
+  def __call__(self, s):
+    '''evaluate a string against this DFA, return True or False'''
+    classes = self.classes.map
+    state = self.initial
+    for c in s:
+      cls = classes[ord(c)]
+      child = state.next[cls]
+      if child is UNKNOWN:
+        child = self.__step(state, cls)
+      if child is None:
+        # there's no transition so there's no match
+        return False
+      state = child
+    return state.match
+
+
 def distinctArcs(arcs):
   '''for a dict of arcs { charset->(state,state) } produce a new dict 
   { charset->(state, state) } that represents an equivalent mapping
@@ -89,7 +384,7 @@ def distinctArcs(arcs):
   charset_by_states_key = {}
   states_by_states_key = {}
   for charset, states in charsets.items():
-    states_key = tuple([str(state.id) for state in states])
+    states_key = frozenset(states)
     states_by_states_key[states_key] = states
     if charset_by_states_key.has_key(states_key):
       charset_by_states_key[states_key] = charset_by_states_key[states_key].union(charset)
@@ -127,3 +422,118 @@ def test_distinctArcs():
       {CharacterSet.excluding('abc'): set([state1]), CharacterSet.including('abc'): set([state1,state2])}
 
 
+
+
+def test_DFA():
+  from nfa import NFA
+  for pattern in ('*.[ch]', '*.txt', 'README*', '[!a-c]?', '*.*'):
+    dfa = DFA(NFA.fnmatch(pattern))
+    # every state has a transition slot for every byte class
+    for state in dfa.states:
+      assert len(state.next) == len(dfa.classes)
+    for path in ('test.c', 'test.h', 'test.o', 'README.txt', 'README', 'dc', 'x'):
+      assert dfa(path) == StateMachine.__call__(dfa, path)
+  # *.[ch] only needs three byte classes: '.', 'c' or 'h' and everything else
+  assert len(DFA(NFA.fnmatch('*.[ch]')).classes) == 3
+
+  # minimization preserves behaviour and never adds states
+  for pattern in ('*.[ch]', '*a*', '*a*b*', '?*?', 'README'):
+    dfa = DFA(NFA.fnmatch(pattern))
+    minimized = DFA(NFA.fnmatch(pattern), minimize=True)
+    assert len(minimized.states) <= len(dfa.states)
+    assert minimized.initial in minimized.states
+    for path in ('a', 'ab', 'ba', 'bab', 'test.c', 'README', ''):
+      assert minimized(path) == dfa(path)
+  # construction is iterative, so long patterns don't hit the recursion limit
+  dfa = DFA(NFA.fnmatch('*a' * 1200))
+  assert dfa('a' * 1200) and not dfa('a' * 1199)
+  stats = dfa.stats()
+  assert stats['nfa_states'] == 1201 and stats['states'] == len(dfa.states)
+  assert stats['classes'] == 2 and stats['build_time'] >= 0
+  # once *a?* has matched it keeps matching, so its accepting states merge
+  assert DFA(NFA.fnmatch('*a?*')).minimize() == (4, 3)
+
+
+def test_Cursor():
+  from nfa import NFA, NFAState
+  dfa = DFA(NFA.fnmatch('src/*/test_*.py', pathname=True), minimize=True)
+  cursor = dfa.cursor()
+  assert not cursor.dead() and not cursor.match()
+  # feeding a path in pieces is the same as feeding it all at once
+  lib = cursor.feed('src/').feed('lib/')
+  assert not lib.dead()
+  assert lib.feed('test_x.py').match() and dfa('src/lib/test_x.py')
+  assert not lib.feed('test_x').match() and not lib.feed('test_x').dead()
+  assert lib.feed('x.py').dead()
+  # cursors are immutable
+  assert lib.feed('test_x').state is not lib.feed('test_x.py').state
+  # nothing under doc/ or src/lib/sub/ can match
+  assert cursor.feed('doc').dead()
+  assert lib.feed('sub/').dead()
+  assert lib.feed('sub/').feed('test_x.py').dead()
+
+  # states that can't reach a match are dead even though they have
+  # transitions
+  nfa = NFA.fnmatch('ab')
+  trap = NFAState()
+  trap.add(CharacterSet.excluding(''), trap)
+  nfa.initial.add(CharacterSet.including('x'), trap)
+  nfa.states.append(trap)
+  for minimize in (False, True):
+    dfa = DFA(nfa, minimize=minimize)
+    assert dfa.cursor().feed('x').state is not None
+    assert dfa.cursor().feed('x').dead()
+    assert dfa.cursor().feed('xyz').dead()
+    assert not dfa.cursor().feed('a').dead()
+    assert len(dfa.live()) == len(dfa.states) - 1
+
+
+def test_LazyDFA():
+  from nfa import NFA
+  paths = ('a', 'ab', 'ba', 'bab', 'test.c', 'test.h', 'README', '', 'aXbYc')
+  for pattern in ('*.[ch]', '*a*', '*a*b*c', '?*?', 'README'):
+    dfa = DFA(NFA.fnmatch(pattern))
+    lazy = LazyDFA(NFA.fnmatch(pattern))
+    # nothing but the initial state is built up front
+    assert len(lazy) == 1
+    for path in paths:
+      assert lazy(path) == dfa(path)
+    assert len(lazy) <= len(dfa.states)
+    # a tiny cache gets flushed but still gives the right answers
+    tiny = LazyDFA(NFA.fnmatch(pattern), max_states=2)
+    for path in paths + paths:
+      assert tiny(path) == dfa(path)
+      assert len(tiny) <= 2
+  assert tiny.stats()['flushes'] > 0
+  # the initial state and one other is the smallest cache
+  try:
+    LazyDFA(NFA.fnmatch('*a*'), max_states=1)
+  except AssertionError:
+    pass
+  else:
+    assert False
+
+  # a lazy DFA can be shared between threads, even while it's flushed
+  import sys
+  from threading import Thread
+  dfa = DFA(NFA.fnmatch('*a*b*c'))
+  lazy = LazyDFA(NFA.fnmatch('*a*b*c'), max_states=3)
+  errors = []
+  def work():
+    try:
+      for x in range(200):
+        for path in paths:
+          assert lazy(path) == dfa(path)
+    except Exception, e:
+      errors.append(e)
+  interval = sys.getcheckinterval()
+  sys.setcheckinterval(1)
+  try:
+    threads = [Thread(target=work) for x in range(8)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+  finally:
+    sys.setcheckinterval(interval)
+  assert not errors and len(lazy) <= 3
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+'''fast paths for patterns that don't need an automaton at all: plain
+literals, literal prefixes and suffixes and literals that only have to
+appear somewhere in the path'''
+
+from nfa import NFA
+from dfa import DFA
+from table import Table
+
+
+class FastPath:
+  '''a matcher for a pattern made of literals and at most two stars, using
+  str comparisons rather than an automaton'''
+  def __init__(self, kind, prefix='', suffix=''):
+    '''@kind is one of:
+      'literal': the path is @prefix
+      'any': the pattern is just a star
+      'prefix': the path starts with @prefix
+      'suffix': the path ends with @suffix
+      'prefix-suffix': the path starts with @prefix and ends with @suffix
+      'contains': the path contains @prefix'''
+    self.kind = kind
+    self.prefix = prefix
+    self.suffix = suffix
+    if kind == 'literal':
+      self.test = lambda path: path == prefix
+    elif kind == 'any':
+      self.test = lambda path: True
+    elif kind == 'prefix':
+      self.test = lambda path: path.startswith(prefix)
+    elif kind == 'suffix':
+      self.test = lambda path: path.endswith(suffix)
+    elif kind == 'prefix-suffix':
+      length = len(prefix) + len(suffix)
+      self.test = lambda path: len(path) >= length and \
+          path.startswith(prefix) and path.endswith(suffix)
+    elif kind == 'contains':
+      self.test = lambda path: prefix in path
+    else:
+      raise ValueError('unknown fast path %s' % `kind`)
+
+  def __call__(self, path):
+    '''evaluate a string against the pattern, return True or False'''
+    return self.test(path)
+
+  def strategy(self):
+    '''how paths are matched'''
+    return self.kind
+
+  def __repr__(self):
+    return 'FastPath(%s, %s, %s)' % (`self.kind`, `self.prefix`, `self.suffix`)
+
+
+# marks a star in the elements of a pattern
+STAR = None
+
+def elements(nfa):
+  '''the elements of the pattern that an NFA built by NFA.fnmatch represents,
+  as a list of literal characters and STARs, or None if the pattern has
+  anything else in it'''
+  result = []
+  state = nfa.initial
+  while True:
+    forward = []
+    for charset, child in state:
+      if child is state:
+        # a star matching anything is a loop
+        if not charset.all():
+          return None
+        if not result or result[-1] is not STAR:
+          result.append(STAR)
+      else:
+        forward.append((charset, child))
+    if not forward:
+      # the end of the pattern
+      if not state.match:
+        return None
+      return result
+    if len(forward) > 1:
+      return None
+    charset, state = forward[0]
+    if len(charset) != 1:
+      return None
+    result.append(iter(charset.characters).next())
+
+
+def analyze(nfa):
+  '''a FastPath for the pattern represented by @nfa, or None if it needs an
+  automaton'''
+  parts = elements(nfa)
+  if parts is None:
+    return None
+  # join runs of literal characters
+  literals = []
+  for part in parts:
+    if part is STAR:
+      literals.append(STAR)
+    elif literals and literals[-1] is not STAR:
+      literals[-1] = literals[-1] + part
+    else:
+      literals.append(part)
+
+  if not literals:
+    return FastPath('literal', '')
+  shape = tuple([part is STAR for part in literals])
+  if shape == (False,):
+    return FastPath('literal', literals[0])
+  if shape == (True,):
+    return FastPath('any')
+  if shape == (False, True):
+    return FastPath('prefix', literals[0])
+  if shape == (True, False):
+    return FastPath('suffix', '', literals[1])
+  if shape == (False, True, False):
+    return FastPath('prefix-suffix', literals[0], literals[2])
+  if shape == (True, False, True):
+    return FastPath('contains', literals[1])
+  return None
+
+
+def matcher(pattern, **flags):
+  '''the fastest pure Python matcher for @pattern: a FastPath if there is
+  one, otherwise a table-driven DFA. @flags are passed to NFA.fnmatch'''
+  nfa = NFA.fnmatch(pattern, **flags)
+  fast = analyze(nfa)
+  if fast is not None:
+    return fast
+  return Table(DFA(nfa, minimize=True))
+
+
+def test_FastPath():
+  from fnmatch import fnmatchcase
+  expected = {
+    'README': 'literal',
+    '': 'literal',
+    '*': 'any',
+    '**': 'any',
+    'README*': 'prefix',
+    '*.txt': 'suffix',
+    'READ*.txt': 'prefix-suffix',
+    '*READ*': 'contains',
+    '*.[ch]': 'table',
+    'R?ADME': 'table',
+    '*a*b*': 'table',
+  }
+  paths = ('README', 'README.txt', 'READ.txt', '*.txt', 'x.c', 'RAADME', '',
+      'ab', 'READ', 'xREADx')
+  for pattern, strategy in expected.items():
+    m = matcher(pattern)
+    assert m.strategy() == strategy
+    for path in paths:
+      assert m(path) == fnmatchcase(path, pattern)
+  # escaped stars are literal, which the stdlib doesn't support
+  assert matcher('\\*.txt').strategy() == 'literal'
+  assert matcher('\\*.txt')('*.txt')
+  assert not matcher('\\*.txt')('README.txt')
+  # the prefix and suffix of prefix-suffix can't overlap
+  assert not matcher('ab*ba')('aba')
+  # with pathname stars don't match '/' so they need an automaton
+  assert matcher('*.c', pathname=True).strategy() == 'table'
+  assert not matcher('*.c', pathname=True)('src/x.c')
+  assert matcher('src/x.c', pathname=True).strategy() == 'literal'
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+'''filtering streams of paths, like a faster fnmatch.filter'''
+
+import fastpath
+from parallel import chunks
+
+
+def matcher(pattern, **flags):
+  '''the best matcher for @pattern for filtering lots of paths: a fast path
+  if it has one, otherwise native code, or a table-driven DFA if LLVM isn't
+  available. @flags are passed to NFA.fnmatch'''
+  from nfa import NFA
+  fast = fastpath.analyze(NFA.fnmatch(pattern, **flags))
+  if fast is not None:
+    return fast
+  try:
+    import cache
+    return cache.compile(pattern, **flags)
+  except ImportError:
+    return fastpath.matcher(pattern, **flags)
+
+
+def match_many(matcher, paths):
+  '''match a list of paths, in one call if @matcher supports it'''
+  if hasattr(matcher, 'match_many'):
+    return matcher.match_many(paths)
+  return [matcher(path) for path in paths]
+
+
+def ifilter(pattern, names, chunksize=1024):
+  '''yield the names from the iterable @names that match @pattern. names 
+  are consumed lazily, @chunksize at a time'''
+  m = matcher(pattern)
+  for chunk in chunks(names, chunksize):
+    for name, match in zip(chunk, match_many(m, chunk)):
+      if match:
+        yield name
+
+
+def filter(names, pattern):
+  '''the list of names from @names that match @pattern, like 
+  fnmatch.filter but with the C library's pattern syntax: '\\' escapes the
+  next character, a bracket expression ends at its first ']', and a pattern
+  with an unterminated bracket expression or a trailing '\\' raises 
+  ValueError rather than matching literally'''
+  return list(ifilter(pattern, names))
+
+
+def ifilter_file(pattern, fileobj, chunksize=1024):
+  '''yield the paths, one per line of @fileobj, that match @pattern, 
+  without their line endings'''
+  lines = (line.rstrip('\r\n') for line in fileobj)
+  return ifilter(pattern, lines, chunksize)
+
+
+def filter_lines(pattern, buffer):
+  '''yield the paths, one per line of @buffer, that match @pattern. @buffer
+  can be a str or an mmap. native code matches the lines in place, so only
+  the matching lines are copied'''
+  m = matcher(pattern)
+  match_buffer = getattr(m, 'match_buffer', None)
+  start = 0
+  length = len(buffer)
+  while start < length:
+    end = buffer.find('\n', start)
+    if end < 0:
+      end = length
+    if match_buffer is not None:
+      if match_buffer(buffer, start, end):
+        yield buffer[start:end]
+    else:
+      line = buffer[start:end]
+      if m(line):
+        yield line
+    start = end + 1
+
+
+def test_filters():
+  import fnmatch
+  from StringIO import StringIO
+  names = ['README', 'README.txt', 'test.c', 'test.h', 'x.o', '']
+  for pattern in ('*.[ch]', '*.txt', 'README*', '*'):
+    expected = fnmatch.filter(names, pattern)
+    assert filter(names, pattern) == expected
+    assert list(ifilter(pattern, iter(names), chunksize=2)) == expected
+    data = '\n'.join(names[:-1]) + '\n'
+    assert list(ifilter_file(pattern, StringIO(data))) == \
+        fnmatch.filter(names[:-1], pattern)
+    assert list(filter_lines(pattern, data)) == \
+        fnmatch.filter(names[:-1], pattern)
+    # mmaps are scanned in place
+    from mmap import mmap
+    buffer = mmap(-1, len(data))
+    buffer.write(data)
+    assert list(filter_lines(pattern, buffer)) == \
+        fnmatch.filter(names[:-1], pattern)
+    buffer.close()
+    # the last line doesn't need a line ending
+    assert list(filter_lines(pattern, data[:-1])) == \
+        fnmatch.filter(names[:-1], pattern)
+
+  # the C library's syntax, not Python's
+  assert filter(['!', '\\!'], '\\!') == ['!']
+  for pattern in ('[', '[a-', 'a\\'):
+    try:
+      filter(names, pattern)
+    except ValueError:
+      pass
+    else:
+      assert False, pattern
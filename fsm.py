@@ -1,24 +1,26 @@
 # base classes for finite state machines
 
+from itertools import count
+
 class State:
   '''State base class'''
-  __id = 1
+  # unique ids for states, count() can be shared between threads
+  __ids = count(1)
   def __init__(self, name=None, match=False, description=None):
+    id = State.__ids.next()
     # a list of tuples (characterset, next_state) representing state transitions
     self.children = []
     # a boolean, is this state terminal
     self.match = match
     # an internal identifier, used internally graph generation
-    self.id = '%s_%d' % (self.__class__.__name__, State.__id)
+    self.id = '%s_%d' % (self.__class__.__name__, id)
     # a human-readable name
     self.name = name
     # a human readable description
     self.description = description
     # use the id as the name if none is supplied
     if self.name == None: 
-      self.name = str(State.__id)
-    # give each state a unique id
-    State.__id = State.__id + 1
+      self.name = str(id)
 
 
   def __str__(self):
@@ -53,7 +55,8 @@ class StateMachine:
   '''State machine base class'''
   def __init__(self, initial, states=[]):
     self.initial = initial
-    self.states = states
+    # copy the states so that machines never share the default list
+    self.states = list(states)
     # if the initial state isn't in the states that are passed in, add it
     if self.initial not in self.states:
       self.states.append(self.initial)
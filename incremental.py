@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+'''matching paths that arrive a chunk at a time, such as from sockets and
+pipes, without joining the chunks together first'''
+
+import copy
+
+from cache import PatternCache
+from nfa import NFA
+from dfa import DFA
+from table import Table
+
+
+class StreamMatcher:
+  '''matches a path fed to it in chunks by carrying the DFA's state from one
+  chunk to the next, so memory use is bounded by the size of the chunks
+  rather than the length of the path'''
+
+  def __init__(self, pattern, compile=True, level=2, **flags):
+    '''build a DFA for @pattern and, if @compile is set and LLVM is
+    available, native code to run it optimized at @level (0 for no
+    optimization). @flags are passed to NFA.fnmatch'''
+    self.pattern = pattern
+    self.dfa = DFA(NFA.fnmatch(pattern, **flags), minimize=True)
+    self.compiled = None
+    if compile:
+      try:
+        from compiler import CompiledFeed
+      except ImportError:
+        pass
+      else:
+        self.compiled = CompiledFeed(self.dfa)
+        if level:
+          self.compiled.optimize(level)
+    if self.compiled is None:
+      self.table = Table(self.dfa)
+    self.reset()
+
+  def strategy(self):
+    '''how chunks are matched'''
+    if self.compiled is not None:
+      return 'compiled'
+    return 'table'
+
+  def copy(self):
+    '''a new matcher for the same pattern, at the start of a path. it shares
+    this matcher's DFA and native code, so making one is cheap'''
+    matcher = copy.copy(self)
+    matcher.reset()
+    return matcher
+
+  def reset(self):
+    '''start matching a new path'''
+    if self.compiled is not None:
+      self.state = self.compiled.initial_state
+    else:
+      self.state = self.table.initial
+
+  def feed(self, chunk, start=0, end=None):
+    '''match chunk[start:end] as the next part of the path. @chunk can be a
+    str or a buffer such as a bytearray, an mmap or a memoryview, native code
+    reads it in place'''
+    if self.compiled is not None:
+      self.state = self.compiled.feed(self.state, chunk, start, end)
+      return
+    if end is None:
+      end = len(chunk)
+    next = self.table.next
+    state = self.state
+    for c in bytearray(chunk[start:end]):
+      state = next[state + c]
+    self.state = state
+
+  def result(self):
+    '''does the path fed since the last reset() match?'''
+    if self.compiled is not None:
+      return self.state in self.compiled.accepting
+    n = self.state >> 8
+    return (self.table.accept[n >> 3] >> (n & 7)) & 1 == 1
+
+
+class StreamMatcherCache(PatternCache):
+  '''a cache of StreamMatchers to copy, so that matching the same pattern
+  again doesn't build and compile it again'''
+  def build(self, pattern, level, flags):
+    return StreamMatcher(pattern, level=level, **flags)
+
+# the StreamMatchers copied by match_chunks()
+matchers = StreamMatcherCache(size=100)
+
+def match_chunks(pattern, chunks, **flags):
+  '''does the path made of the iterable of @chunks match @pattern? the
+  compiled pattern is cached'''
+  matcher = matchers.compile(pattern, **flags).copy()
+  for chunk in chunks:
+    matcher.feed(chunk)
+  return matcher.result()
+
+
+def test_StreamMatcher():
+  from fnmatch import fnmatchcase
+  paths = ('README', 'README.txt', 'test.c', 'src/test.c', '', 'a\0b.c')
+  for pattern in ('*.c', 'README*', '*', '', '?*.t?t', '[!a-z]*'):
+    matcher = StreamMatcher(pattern, compile=False)
+    assert matcher.strategy() == 'table'
+    for path in paths:
+      expected = fnmatchcase(path, pattern)
+      # every way of splitting the path into two chunks
+      for split in range(len(path) + 1):
+        matcher.reset()
+        matcher.feed(path[:split])
+        matcher.feed(bytearray(path[split:]))
+        assert matcher.result() == expected
+      # one octet at a time, out of a larger buffer
+      matcher.reset()
+      padded = 'xx' + path + 'yy'
+      for offset in range(2, len(path) + 2):
+        matcher.feed(padded, offset, offset + 1)
+      assert matcher.result() == expected
+  # a dead path stays dead
+  matcher = StreamMatcher('a*', compile=False)
+  matcher.feed('b')
+  matcher.feed('a')
+  assert not matcher.result()
+  # flags are passed through
+  matcher = StreamMatcher('*.c', compile=False, pathname=True)
+  matcher.feed('src/')
+  matcher.feed('x.c')
+  assert not matcher.result()
+
+  # copies start afresh and don't share their state
+  copied = matcher.copy()
+  copied.feed('x.c')
+  assert copied.result() and not matcher.result()
+  assert copied.dfa is matcher.dfa
+
+  assert match_chunks('*.c', ['sr', 'c/x', '.c'])
+  assert not match_chunks('*.c', ['sr', 'c/x', '.c'], pathname=True)
+  assert match_chunks('*.c', ['x', '.c'], pathname=True)
+
+  # the cache builds each pattern and set of flags once
+  cache = StreamMatcherCache(size=10)
+  matcher = cache.compile('*.c', pathname=True)
+  assert cache.compile('*.c', pathname=True) is matcher
+  assert cache.compile('*.c') is not matcher
+  stats = cache.stats()
+  assert stats['misses'] == 2 and stats['hits'] == 1
@@ -4,35 +4,126 @@ from characterset import CharacterSet, distinctCharacterSets
 from fsm import State, StateMachine
 
 class NFAState(State):
-  pass
+  # the ids of the patterns that this state matches, for sets of patterns
+  patterns = frozenset()
 
 
 class NFA(StateMachine):
   @classmethod
-  def fnmatch(klass, s):
-    '''create an NFA state machine representing the fnmatch pattern @s'''
+  def fnmatch(klass, s, pathname=False, period=False, casefold=False):
+    '''create an NFA state machine representing the fnmatch pattern @s.
+    like the flags to the C library's fnmatch():
+      @pathname: wildcards and bracket expressions don't match '/', and '**'
+        matches across directories. '**/' at the start of a path component
+        matches zero or more whole directories
+      @period: a leading '.', at the start of the string or of a path
+        component if @pathname is set, is only matched by a literal '.'
+    and like FNM_CASEFOLD:
+      @casefold: ASCII letters match regardless of case
+    '''
     nfa = NFA(NFAState())
-    state = nfa.initial
-    new_state = None
+    anything = CharacterSet.excluding('')
+    dot = CharacterSet.including('.')
+    slash = CharacterSet.including('/')
+    if pathname:
+      # wildcards match anything but '/'
+      wildcard = CharacterSet.excluding('/')
+    else:
+      wildcard = anything
+    # the states the next element of the pattern is matched from, each with
+    # flags saying whether it's at the start of a path component and whether
+    # a star at the start of the component matched nothing to get there
+    heads = [(nfa.initial, True, False)]
     chars = list(s)
     while True:
       if len(chars) == 0: break # end-of-string
       c = chars.pop(0)
-      new_state = NFAState()
-      nfa.states.append(new_state)
+      if c == '*':
+        crossing = False
+        if pathname and chars[:1] == ['*']:
+          # two or more stars match across directories
+          while chars[:1] == ['*']: chars.pop(0)
+          crossing = True
+          # as a whole path component, '**/' matches zero or more whole
+          # directories
+          component = len([leading for state, leading, starred in heads
+            if not leading]) == 0
+          if component and chars[:1] == ['/']:
+            chars.pop(0)
+            # a state for inside a directory's name and one for after the
+            # '/' at its end
+            directory = NFAState()
+            after = NFAState()
+            nfa.states.extend([directory, after])
+            first = wildcard
+            if period:
+              first = first - dot
+            for state, leading, starred in heads:
+              state.add(first, directory)
+            directory.add(wildcard, directory)
+            directory.add(slash, after)
+            after.add(first, directory)
+            heads = heads + [(after, True, False)]
+            continue
+        if crossing and period:
+          # a star that matches across directories, where no component can
+          # start with a '.', has a state for inside a component and one for
+          # the start of one
+          new_heads = []
+          for state, leading, starred in heads:
+            inside = NFAState()
+            start = NFAState()
+            nfa.states.extend([inside, start])
+            if leading:
+              state.add(wildcard - dot, inside)
+            else:
+              state.add(wildcard, inside)
+            state.add(slash, start)
+            inside.add(wildcard, inside)
+            inside.add(slash, start)
+            start.add(wildcard - dot, inside)
+            start.add(slash, start)
+            new_heads.append((state, leading, True))
+            new_heads.append((inside, False, False))
+            new_heads.append((start, True, False))
+          heads = new_heads
+          continue
+        if crossing:
+          star = anything
+        else:
+          star = wildcard
+        # multi-character wildcard, a loop so that it can match zero
+        # characters too
+        new_heads = []
+        for state, leading, starred in heads:
+          if period and leading:
+            # the first character can't be a leading '.', so it gets a
+            # state of its own
+            new_state = NFAState()
+            nfa.states.append(new_state)
+            state.add(star - dot, new_state)
+            new_state.add(star, new_state)
+            new_heads.append((state, leading, True))
+            new_heads.append((new_state, False, False))
+          else:
+            state.add(star, state)
+            new_heads.append((state, leading, starred))
+        heads = new_heads
+        continue
+      # work out which characters the element matches
+      wild = True
       if c == '?':
         # single-character wildcard
-        state.add(CharacterSet.excluding(''), new_state)
-      elif c == '*':
-        # multi-character wildcard
-        state.add(CharacterSet.excluding(''), new_state)
-        new_state.add(CharacterSet.excluding(''), new_state)
+        charset = wildcard
       elif c == '\\':
         # treat the next character literally
         if len(chars) == 0:
-          raise 'escape at end of string'
+          raise ValueError('escape at end of string')
         c = chars.pop(0)
-        state.add(CharacterSet.including(c), new_state)
+        charset = CharacterSet.including(c)
+        if casefold:
+          charset = charset.casefold()
+        wild = False
       elif c == '[':
         # bracket expression
         try:
@@ -53,19 +144,120 @@ class NFA(StateMachine):
               continue
             charset = charset.union(CharacterSet.including(c))
             last_char = c # save last character
-            c = sio.read(1)
+            c = chars.pop(0)
         except IndexError, e:
-          raise 'unterminated bracket expression'
+          raise ValueError('unterminated bracket expression')
+        if casefold:
+          charset = charset.casefold()
         if inverted:
-          state.add(CharacterSet.excluding('') - charset, new_state)
-        else:
-          state.add(charset, new_state)
+          charset = CharacterSet.excluding('') - charset
+        charset = charset.intersection(wildcard)
       else:
-        state.add(CharacterSet.including(c), new_state)
-      state = new_state
-    state.match = True
+        charset = CharacterSet.including(c)
+        if casefold:
+          charset = charset.casefold()
+        wild = False
+      new_state = NFAState()
+      nfa.states.append(new_state)
+      for state, leading, starred in heads:
+        arc = charset
+        if period and leading and (wild or starred):
+          # wildcards can't match a leading '.', and nothing can after a
+          # star that did
+          arc = arc - dot
+        if not arc.empty():
+          state.add(arc, new_state)
+      heads = [(new_state, pathname and not wild and c == '/', False)]
+    for state, leading, starred in heads:
+      state.match = True
     return nfa
 
   def __init__(self, initial, states=[]):
     StateMachine.__init__(self, initial, states)
 
+
+def test_fnmatch_flags():
+  def match(pattern, path, **flags):
+    return NFA.fnmatch(pattern, **flags)(path)
+
+  # without flags wildcards match anything
+  assert match('*.c', 'src/x.c') and match('?', '/') and match('*', '.x')
+  assert match('[!a]', '/')
+
+  # wildcards don't match '/' with pathname
+  assert not match('*.c', 'src/x.c', pathname=True)
+  assert match('*/*.c', 'src/x.c', pathname=True)
+  assert not match('?', '/', pathname=True)
+  assert not match('[!a]', '/', pathname=True)
+  assert not match('[/]', '/', pathname=True)
+  assert match('src/x.c', 'src/x.c', pathname=True)
+
+  # ** matches across directories, **/ matches zero or more directories
+  assert match('**.c', 'src/lib/x.c', pathname=True)
+  assert match('src/**/*.c', 'src/x.c', pathname=True)
+  assert match('src/**/*.c', 'src/lib/x.c', pathname=True)
+  assert match('src/**/*.c', 'src/lib/sub/x.c', pathname=True)
+  assert not match('src/**/*.c', 'src/lib/x.h', pathname=True)
+  assert not match('src/**/*.c', 'srcx.c', pathname=True)
+  assert match('**/x.c', 'x.c', pathname=True)
+  assert match('**/x.c', 'a/b/x.c', pathname=True)
+
+  # a leading period has to be matched explicitly with period
+  assert not match('*', '.profile', period=True)
+  assert not match('?profile', '.profile', period=True)
+  assert not match('[.]profile', '.profile', period=True)
+  assert not match('*.profile', '.profile', period=True)
+  assert match('.*', '.profile', period=True)
+  assert match('*', 'x.profile', period=True)
+  assert match('x*', 'x.profile', period=True)
+  assert match('*.c', 'x.c', period=True)
+  assert match('*', '', period=True)
+  # and at the start of every component with pathname
+  assert match('*/*', 'a/.b')
+  assert match('*/*', 'a/.b', pathname=True)
+  assert not match('*/*', 'a/.b', pathname=True, period=True)
+  assert match('*/.*', 'a/.b', pathname=True, period=True)
+  assert match('*/*', 'a/b.c', pathname=True, period=True)
+  assert not match('**/x.c', '.git/x.c', pathname=True, period=True)
+  assert match('**/x.c', 'a/x.c', pathname=True, period=True)
+  # including the components that ** matches across
+  assert match('**/x.c', 'a/b/x.c', pathname=True, period=True)
+  assert not match('**/x.c', 'a/.git/x.c', pathname=True, period=True)
+  assert not match('**/x.c', 'a/b/.git/x.c', pathname=True, period=True)
+  assert match('src/**/*.c', 'src/a/b/x.c', pathname=True, period=True)
+  assert not match('src/**/*.c', 'src/a/.hidden/x.c', pathname=True, 
+      period=True)
+  assert not match('src/**/*.c', 'src/a/.x.c', pathname=True, period=True)
+  assert match('src/**', 'src/a/b', pathname=True, period=True)
+  assert not match('src/**', 'src/.git', pathname=True, period=True)
+  assert not match('src/**', 'src/a/.git', pathname=True, period=True)
+  assert not match('src/**', 'src/a/b/.git/c', pathname=True, period=True)
+  assert match('a**', 'ab/c', pathname=True, period=True)
+  assert match('a**', 'a.b', pathname=True, period=True)
+  assert not match('a**', 'ab/.c', pathname=True, period=True)
+  assert not match('a**', 'a/.c', pathname=True, period=True)
+  assert match('a**/.c', 'a/b/.c', pathname=True, period=True)
+
+  # ** is only a globstar as a whole component, elsewhere it's a star that
+  # matches across directories and a following '/' is a literal
+  assert match('a**/b', 'a/b', pathname=True)
+  assert match('a**/b', 'ax/y/b', pathname=True)
+  assert not match('a**/b', 'ab', pathname=True)
+  assert match('src**/x.c', 'src/lib/x.c', pathname=True)
+  assert not match('src**/x.c', 'srcx.c', pathname=True)
+  assert match('x/**/y', 'x/y', pathname=True)
+  assert match('**/**/y', 'y', pathname=True)
+  assert match('**/**/y', 'a/b/y', pathname=True)
+
+  # letters match either case with casefold, including in brackets
+  assert not match('README.txt', 'readme.TXT')
+  assert match('README.txt', 'readme.TXT', casefold=True)
+  assert match('\\R*', 'readme', casefold=True)
+  assert match('[a-c]x', 'BX', casefold=True)
+  assert not match('[a-c]x', 'DX', casefold=True)
+  # inverted brackets exclude both cases
+  assert not match('[!a]', 'A', casefold=True)
+  assert match('[!a]', 'b', casefold=True)
+  # only ASCII letters are folded
+  assert not match('\\[', '{', casefold=True)
+  assert not match('\xe9', '\xc9', casefold=True)
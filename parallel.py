@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+'''matching huge numbers of paths against a set of patterns using a pool of
+worker processes'''
+
+from collections import deque
+from itertools import islice
+from multiprocessing import Pool, cpu_count
+
+from patternset import PatternSet
+from table import Table
+
+
+# the tables used by a worker process
+_table = None
+
+def _initialize(data):
+  '''set up a worker process with the tables saved in @data'''
+  global _table
+  _table = Table(data=data)
+
+def _match(chunk):
+  '''match a chunk of paths in a worker process'''
+  mask = _table.mask
+  return [mask(path) for path in chunk]
+
+
+def chunks(iterable, size):
+  '''split @iterable into lists of @size items'''
+  iterator = iter(iterable)
+  while True:
+    chunk = list(islice(iterator, size))
+    if not chunk:
+      return
+    yield chunk
+
+
+def match_parallel(patterns, paths, workers=None, chunksize=10000):
+  '''match each of @paths against every one of @patterns using @workers
+  processes (by default, one per CPU). yields, in order, a bitmask for each
+  path with bit n set if patterns[n] matches it. the patterns are built into
+  a single DFA once and its tables are sent to each worker when it starts;
+  paths are read lazily and sent to the workers in chunks of @chunksize, 
+  with at most two chunks per worker in flight at a time'''
+  if workers is None:
+    workers = cpu_count()
+  data = Table(PatternSet(patterns).dfa).dumps()
+  pool = Pool(workers, _initialize, (data,))
+  try:
+    pending = deque()
+    for chunk in chunks(paths, chunksize):
+      pending.append(pool.apply_async(_match, (chunk,)))
+      if len(pending) >= 2 * workers:
+        for mask in pending.popleft().get():
+          yield mask
+    while pending:
+      for mask in pending.popleft().get():
+        yield mask
+    pool.close()
+  finally:
+    pool.terminate()
+    pool.join()
+
+
+def test_match_parallel():
+  from fnmatch import fnmatchcase
+  patterns = ('*.[ch]', '*.txt', 'README*', '*')
+  paths = ['%s%d%s' % (name, n, ext) for n in range(50) 
+      for name in ('README', 'test') for ext in ('', '.c', '.txt')]
+  expected = [sum([1 << id for id, pattern in enumerate(patterns) 
+    if fnmatchcase(path, pattern)]) for path in paths]
+  assert list(match_parallel(patterns, iter(paths), workers=2, 
+    chunksize=7)) == expected
+  assert list(match_parallel(patterns, [], workers=1)) == []
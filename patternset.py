@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+from nfa import NFA, NFAState
+from dfa import DFA
+
+
+class PatternSet:
+  '''a set of fnmatch patterns that are matched together by a single
+  automaton, reporting which of the patterns match'''
+  def __init__(self, patterns, minimize=True, **flags):
+    '''build a DFA that matches any of @patterns. patterns are identified by
+    their index in @patterns. @flags are passed to NFA.fnmatch'''
+    self.patterns = list(patterns)
+
+    # the union of the patterns' NFAs. the NFAs don't have epsilon 
+    # transitions so the union's initial state takes copies of the arcs of
+    # each pattern's initial state
+    self.nfa = NFA(NFAState())
+    for id, pattern in enumerate(self.patterns):
+      nfa = NFA.fnmatch(pattern, **flags)
+      for state in nfa:
+        if state.match:
+          state.patterns = frozenset([id])
+      for charset, child in nfa.initial:
+        self.nfa.initial.add(charset, child)
+      if nfa.initial.match:
+        self.nfa.initial.match = True
+        self.nfa.initial.patterns = self.nfa.initial.patterns.union([id])
+      self.nfa.states.extend(nfa.states)
+
+    self.dfa = DFA(self.nfa, minimize=minimize)
+
+  def __len__(self):
+    '''the number of patterns in the set'''
+    return len(self.patterns)
+
+  def match(self, path):
+    '''the set of ids of the patterns that match @path'''
+    state = self.dfa.final(path)
+    if state is None:
+      return frozenset()
+    return state.patterns
+
+  def first(self, path):
+    '''the id of the first pattern that matches @path, or None'''
+    patterns = self.match(path)
+    if patterns:
+      return min(patterns)
+    return None
+
+  def __call__(self, path):
+    '''does any pattern match @path?'''
+    return self.dfa(path)
+
+  def compile(self, first=False):
+    '''compile the set into a single native function returning a bitmask of
+    the matching patterns, however many there are, or the id of the first
+    matching pattern if @first is set'''
+    from compiler import CompiledPatternSet
+    return CompiledPatternSet(self.dfa, first=first)
+
+
+def test_PatternSet():
+  from fnmatch import fnmatchcase
+  patterns = ('*.txt', '*', 'README*', '*.[ch]', 'README', '')
+  paths = ('test.c', 'README.txt', 'README', 'x.h', '', 'a.txt.o')
+  patternset = PatternSet(patterns)
+  assert len(patternset) == len(patterns)
+  for path in paths:
+    expected = frozenset([id for id, pattern in enumerate(patterns) 
+      if fnmatchcase(path, pattern)])
+    assert patternset.match(path) == expected
+    assert patternset(path) == bool(expected)
+    assert patternset.first(path) == (min(expected) if expected else None)
+
+  # a set with nothing in common
+  patternset = PatternSet(('a', 'b'))
+  assert patternset.match('c') == frozenset()
+  assert patternset.first('c') == None
+  assert not patternset('c')
+  assert patternset.first('b') == 1
+
+  # flags apply to every pattern in the set
+  patternset = PatternSet(('*.c', 'src/**/*.h', '*'), pathname=True)
+  assert patternset.match('x.c') == frozenset([0, 2])
+  assert patternset.match('src/x.c') == frozenset()
+  assert patternset.match('src/lib/x.h') == frozenset([1])
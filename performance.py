@@ -59,8 +59,10 @@ def compile_native_test(compiled, pattern, path, count):
 def test(pattern, path, count):
   print 'fnmatch(%s, %s) %d times...' % (path, pattern, count)
   start_compile = datetime.now()
-  compiled = Compiled(DFA(NFA.fnmatch(pattern)))
-  compiled.optimize() # slow!
+  dfa = DFA(NFA.fnmatch(pattern))
+  dfa_states, minimized_states = dfa.minimize()
+  compiled = Compiled(dfa)
+  compiled.optimize()
   end_compile = datetime.now()
 
   start_execution = datetime.now()
@@ -68,12 +70,24 @@ def test(pattern, path, count):
     compiled(path)
   end_execution = datetime.now()
 
+  paths = [path] * count
+  start_batch = datetime.now()
+  compiled.match_many(paths)
+  end_batch = datetime.now()
+
   native_test = compile_native_test(compiled, pattern, path, count)
 
   start_native = datetime.now()
   native_test()
   end_native = datetime.now()
 
+  import fastpath
+  fast = fastpath.matcher(pattern)
+  start_fast = datetime.now()
+  for x in range(count):
+    fast(path)
+  end_fast = datetime.now()
+
   from fnmatch import fnmatch
 
   start_builtin = datetime.now()
@@ -85,9 +99,14 @@ def test(pattern, path, count):
     'pattern': pattern,
     'path': path,
     'count': count,
+    'dfa_states': dfa_states,
+    'minimized_states': minimized_states,
     'compile_time': (end_compile-start_compile),
     'execution_time': (end_execution-start_execution),
+    'batch_time': (end_batch-start_batch),
     'native_time': (end_native-start_native),
+    'strategy': fast.strategy(),
+    'fast_time': (end_fast-start_fast),
     'builtin_time': (end_builtin-start_builtin),
   }
   
@@ -119,9 +138,12 @@ results = (test(pattern, path, options.count) for pattern, path in TESTS)
 if op.format == 'text':
   for result in results:
     print '''fnmatch(%(path)s, %(pattern)s) %(count)d times...
+dfa states:     %(dfa_states)d (%(minimized_states)d minimized)
 compile time:   %(compile_time)s
 execution time: %(execution_time)s
+batch time:     %(batch_time)s
 native time:    %(native_time)s
+fast path time: %(fast_time)s (%(strategy)s)
 builtin time:   %(builtin_time)s
 ''' % result
   elif op.format == 'csv':
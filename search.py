@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+'''searching buffers for the places where a pattern matches'''
+
+from cache import PatternCache
+from characterset import CharacterSet
+from nfa import NFA
+from dfa import DFA
+from table import Table
+
+
+def unanchored(nfa):
+  '''make @nfa match strings that end with a match rather than just matches,
+  by looping its initial state back on itself'''
+  nfa.initial.add(CharacterSet.excluding(''), nfa.initial)
+  return nfa
+
+
+class Searcher:
+  '''finds the offsets in a buffer at which matches of a pattern end'''
+  # the number of octets of the buffer the pure Python search copies at once
+  chunksize = 65536
+
+  def __init__(self, pattern, compile=True, level=2):
+    '''build an unanchored DFA for @pattern and, if @compile is set and LLVM
+    is available, a native scan loop optimized at @level (0 for no
+    optimization)'''
+    self.pattern = pattern
+    self.dfa = DFA(unanchored(NFA.fnmatch(pattern)), minimize=True)
+    self.compiled = None
+    if compile:
+      try:
+        from compiler import CompiledSearch
+      except ImportError:
+        pass
+      else:
+        self.compiled = CompiledSearch(self.dfa)
+        if level:
+          self.compiled.optimize(level)
+    if self.compiled is None:
+      self.table = Table(self.dfa)
+      # whether each state accepts, indexed by state number
+      self.accepting = bytearray([(self.table.accept[n >> 3] >> (n & 7)) & 1
+          for n in range(len(self.table))])
+
+  def strategy(self):
+    '''how buffers are searched'''
+    if self.compiled is not None:
+      return 'compiled'
+    return 'table'
+
+  def finditer(self, buffer, start=0, end=None):
+    '''yield the offsets just past the end of each match of the pattern in
+    buffer[start:end], in order. @buffer can be a str or a buffer such as an
+    mmap. a pattern that matches the empty string matches at @start too'''
+    if end is None:
+      end = len(buffer)
+    if self.dfa.initial.match:
+      yield start
+    if self.compiled is not None:
+      for offset in self.compiled.scan(buffer, start, end):
+        yield offset
+      return
+
+    next = self.table.next
+    accepting = self.accepting
+    state = self.table.initial
+    for chunk in xrange(start, end, self.chunksize):
+      offset = chunk
+      for c in bytearray(buffer[chunk:min(chunk+self.chunksize, end)]):
+        state = next[state + c]
+        offset += 1
+        if accepting[state >> 8]:
+          yield offset
+
+
+class SearcherCache(PatternCache):
+  '''a cache of Searchers, so that searching for the same pattern again
+  doesn't build and compile it again'''
+  def build(self, pattern, level, flags):
+    return Searcher(pattern, level=level)
+
+# the Searchers used by finditer()
+searchers = SearcherCache(size=100)
+
+def finditer(pattern, buffer, start=0, end=None):
+  '''yield the offsets just past the end of each match of @pattern in 
+  buffer[start:end]. the Searcher for @pattern is cached'''
+  return searchers.compile(pattern).finditer(buffer, start, end)
+
+
+def test_Searcher():
+  from fnmatch import fnmatchcase
+  text = 'README.txt test.c x.h README\nfoo.c'
+  for pattern in ('*.[ch]', '.txt', 'README', '?.[ch]', '*', 'x*h', ''):
+    expected = [end for end in range(len(text)+1) 
+        if [start for start in range(end+1) 
+          if fnmatchcase(text[start:end], pattern)]]
+    searcher = Searcher(pattern, compile=False)
+    assert searcher.strategy() == 'table'
+    assert list(searcher.finditer(text)) == expected
+    # in small chunks, and in part of the text
+    searcher.chunksize = 3
+    assert list(searcher.finditer(text)) == expected
+    assert list(searcher.finditer(text, 0, 10)) == \
+        [end for end in expected if end <= 10]
+    assert list(finditer(pattern, text)) == expected
+
+  # finditer() only builds a Searcher for a pattern once
+  searcher = searchers.compile('*.[ch]')
+  assert list(finditer('*.[ch]', text)) == list(searcher.finditer(text))
+  assert searchers.compile('*.[ch]') is searcher
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+'''bit-parallel simulation of the NFAs built by NFA.fnmatch'''
+
+
+class ShiftAnd:
+  '''simulates a chain NFA, where each state only has arcs to itself and to
+  the next state, by keeping the set of active states in the bits of an 
+  integer. this needs no determinization or compilation, so it's ideal for
+  patterns that are only used a few times. it's fastest when the pattern has
+  fewer elements than a machine word has bits'''
+  def __init__(self, nfa):
+    '''build the masks for @nfa, raises ValueError if it isn't a chain'''
+    # walk the chain, numbering the states
+    chain = []
+    state = nfa.initial
+    while state is not None:
+      chain.append(state)
+      forward = [(charset, child) for charset, child in state 
+          if child is not state]
+      if len(set([child for charset, child in forward])) > 1:
+        raise ValueError('NFA state %s has more than one successor' % state)
+      if forward and forward[0][1] in chain:
+        raise ValueError('NFA state %s loops back' % state)
+      state = forward and forward[0][1] or None
+
+    # for each octet, the mask of the states that can be entered from their
+    # predecessor and the mask of states that loop back to themselves
+    self.masks = [0] * 256
+    self.loops = [0] * 256
+    self.accept = 0
+    for n, state in enumerate(chain):
+      for charset, child in state:
+        if child is state:
+          masks, bit = self.loops, 1 << n
+        else:
+          masks, bit = self.masks, 1 << (n+1)
+        for c in range(256):
+          if (charset.bits >> c) & 1:
+            masks[c] |= bit
+      if state.match:
+        self.accept |= 1 << n
+    self.size = len(chain)
+
+  def __len__(self):
+    '''the number of states, one bit each'''
+    return self.size
+
+  def strategy(self):
+    '''how paths are matched'''
+    return 'shift-and'
+
+  def __call__(self, path):
+    '''evaluate a string against the pattern, return True or False'''
+    masks = self.masks
+    loops = self.loops
+    active = 1
+    for c in bytearray(path):
+      active = ((active << 1) & masks[c]) | (active & loops[c])
+      if not active:
+        return False
+    return active & self.accept != 0
+
+
+def test_ShiftAnd():
+  from nfa import NFA
+  from fnmatch import fnmatchcase
+  paths = ('test.c', 'test.h', 'README.txt', 'README', 'dc', '', 'aXbYc', 
+      'abc', '\xff.c')
+  for pattern in ('*.[ch]', '*.txt', 'README*', 'README', '[!a-c]?', '*.*', 
+      '*', '*a*b*c', '?', ''):
+    shiftand = ShiftAnd(NFA.fnmatch(pattern))
+    for path in paths:
+      assert shiftand(path) == fnmatchcase(path, pattern)
+  # one bit per state, more than fits in a machine word still works
+  shiftand = ShiftAnd(NFA.fnmatch('a*' * 100))
+  assert len(shiftand) == 101
+  assert shiftand('a' * 100) and not shiftand('a' * 99)
+
+  # pattern sets aren't chains
+  from patternset import PatternSet
+  try:
+    ShiftAnd(PatternSet(('a', 'b')).nfa)
+  except ValueError:
+    pass
+  else:
+    assert False
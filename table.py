@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+from array import array
+
+
+class Table:
+  '''a DFA compiled into flat transition tables, for matching in pure Python
+  where LLVM isn't available'''
+  def __init__(self, dfa=None, data=None):
+    '''build the tables for @dfa, or load tables saved with dumps() from the
+    str @data'''
+    if data is not None:
+      self.__load(data)
+      return
+    if dfa is None:
+      raise ValueError('one of dfa or data is required')
+
+    # number the states densely: 0 is the dead state that every missing
+    # transition leads to and 1 is the initial state
+    states = [dfa.initial] + [state for state in dfa.states 
+        if state is not dfa.initial]
+    numbers = dict([(state, n+1) for n, state in enumerate(states)])
+    self.size = len(states) + 1
+
+    # the transition table, indexed by state*256+octet. the states stored in
+    # the table are premultiplied by 256 so that matching only needs one
+    # addition and one index per octet
+    self.next = array('l', [0]) * (256 * self.size)
+    for state in states:
+      row = numbers[state] * 256
+      for c in range(256):
+        child = state.next[dfa.classes.map[c]]
+        if child is not None:
+          self.next[row + c] = numbers[child] * 256
+
+    # a bitmap of the accepting states
+    self.accept = bytearray((self.size + 7) // 8)
+    for state in states:
+      if state.match:
+        n = numbers[state]
+        self.accept[n >> 3] |= 1 << (n & 7)
+
+    # for the DFAs of pattern sets, the bitmask of the patterns that each
+    # state matches
+    self.masks = [0] * self.size
+    for state in states:
+      self.masks[numbers[state]] = sum([1 << id for id in state.patterns])
+
+    self.initial = 256
+
+  def dumps(self):
+    '''the tables as a str, which can be loaded with Table(data=...)'''
+    from cPickle import dumps
+    return dumps((self.size, self.next.tostring(), str(self.accept), 
+      self.masks), 2)
+
+  def __load(self, data):
+    '''load tables saved with dumps()'''
+    from cPickle import loads
+    self.size, next, accept, self.masks = loads(data)
+    self.next = array('l')
+    self.next.fromstring(next)
+    self.accept = bytearray(accept)
+    self.initial = 256
+
+  def __len__(self):
+    '''the number of states, including the dead state'''
+    return self.size
+
+  def strategy(self):
+    '''how paths are matched'''
+    return 'table'
+
+  def __call__(self, path):
+    '''evaluate a string against the tables, return True or False'''
+    next = self.next
+    state = self.initial
+    for c in bytearray(path):
+      state = next[state + c]
+    n = state >> 8
+    return (self.accept[n >> 3] >> (n & 7)) & 1 == 1
+
+  def match_many(self, paths):
+    '''match each of @paths, returning a bytearray with a 1 for each path 
+    that matches and a 0 for each that doesn't'''
+    return bytearray([self(path) for path in paths])
+
+  def mask(self, path):
+    '''the bitmask of the patterns that match @path, for the tables of a
+    PatternSet's DFA'''
+    next = self.next
+    state = self.initial
+    for c in bytearray(path):
+      state = next[state + c]
+    return self.masks[state >> 8]
+
+
+def test_Table():
+  from nfa import NFA
+  from dfa import DFA
+  from fnmatch import fnmatchcase
+  for pattern in ('*.[ch]', '*.txt', 'README*', 'README', '[!a-c]?', '*.*', '*'):
+    table = Table(DFA(NFA.fnmatch(pattern)))
+    for path in ('test.c', 'test.h', 'README.txt', 'README', 'dc', '', '\xff.c'):
+      assert table(path) == fnmatchcase(path, pattern)
+
+  # tables survive being saved and loaded
+  from patternset import PatternSet
+  patterns = ('*.[ch]', '*.txt', 'README*')
+  table = Table(PatternSet(patterns).dfa)
+  loaded = Table(data=table.dumps())
+  for path in ('test.c', 'README.txt', 'README', 'x'):
+    expected = sum([1 << id for id, pattern in enumerate(patterns)
+      if fnmatchcase(path, pattern)])
+    assert table.mask(path) == loaded.mask(path) == expected
+    assert table(path) == loaded(path) == bool(expected)
+
+  # there has to be something to build the tables from
+  try:
+    Table()
+  except ValueError:
+    pass
+  else:
+    assert False
@@ -4,15 +4,45 @@
 from dfa import DFA
 from nfa import NFA
 from compiler import Compiled
+from table import Table
 
 # the python implementation
 import fnmatch
 
 # run unit self tests
-from characterset import test_CharacterSet
+from characterset import test_CharacterSet, test_ByteClasses
 test_CharacterSet()
-from dfa import test_distinctArcs
+test_ByteClasses()
+from dfa import test_distinctArcs, test_DFA, test_Cursor, test_LazyDFA
 test_distinctArcs()
+test_DFA()
+test_Cursor()
+test_LazyDFA()
+from table import test_Table
+test_Table()
+from patternset import test_PatternSet
+test_PatternSet()
+from shiftand import test_ShiftAnd
+test_ShiftAnd()
+from fastpath import test_FastPath
+test_FastPath()
+from tiered import test_Matcher
+test_Matcher()
+from parallel import test_match_parallel
+test_match_parallel()
+from filters import test_filters
+test_filters()
+from search import test_Searcher
+test_Searcher()
+from nfa import test_fnmatch_flags
+test_fnmatch_flags()
+from walk import test_walk
+test_walk()
+from incremental import test_StreamMatcher
+test_StreamMatcher()
+from cache import test_PatternCache, test_DiskCache
+test_PatternCache()
+test_DiskCache()
 
 PATTERNS = ('*.txt', '*', '*.*', 'README.*')
 PATHS = ('test.c', 'README.txt', 'README')
@@ -22,9 +52,290 @@ for pattern in PATTERNS:
   dfa = DFA(nfa)
   compiled = Compiled(dfa, debug=False)
   compiled.optimize()
+  table = Table(dfa)
+  assert compiled.match_many(PATHS) == bytearray(
+      [fnmatch.fnmatch(path, pattern) for path in PATHS])
   for path in PATHS:
     expected = fnmatch.fnmatch(path, pattern)
     assert nfa(path) == expected
     assert dfa(path) == expected
     assert compiled(path) == expected
+    assert compiled.run(path) == expected
+    assert table(path) == expected
+    # the sized function matches slices of buffers in place
+    padded = 'xx' + path + '\0yy'
+    assert compiled.match_buffer(padded, 2, 2+len(path)) == expected
+    assert compiled.match_buffer(bytearray(path)) == expected
+    assert compiled.match_buffer(buffer(path)) == expected
+    assert compiled.match_buffer(memoryview(padded), 2, 2+len(path)) == \
+        expected
+    assert compiled.match_buffer(memoryview(bytearray(path))) == expected
+  # NUL is just another octet to the sized function
+  assert compiled.match_buffer('README\0.txt') == \
+      fnmatch.fnmatch('README\0.txt', pattern)
+  # and paths with NULs in them don't throw out match_many's other results
+  nul_paths = ('README\0.txt', 'test.c', 'a\0b\0', 'README.txt', '\0')
+  assert compiled.match_many(nul_paths) == bytearray(
+      [fnmatch.fnmatch(path, pattern) for path in nul_paths])
+  assert compiled.match_many([]) == bytearray()
 
+# read-only mmaps, the usual way to map a file, are matched in place too
+from mmap import mmap, ACCESS_READ
+from tempfile import TemporaryFile
+mapped_file = TemporaryFile()
+mapped_file.write('\n'.join(PATHS))
+mapped_file.flush()
+mapped = mmap(mapped_file.fileno(), 0, access=ACCESS_READ)
+for pattern in PATTERNS:
+  compiled = Compiled(DFA(NFA.fnmatch(pattern)))
+  offset = 0
+  for path in PATHS:
+    assert compiled.match_buffer(mapped, offset, offset+len(path)) == \
+        fnmatch.fnmatch(path, pattern)
+    offset += len(path) + 1
+
+
+# bracket expressions exercise every dispatch strategy: switches, ranges and
+# lookup tables
+BRACKET_PATTERNS = ('[a-z0-9]*.c', '*[!aeiou]', '[acegikmoqsuwy]*', 
+    '*[!acegikmoqsuwy02468]?')
+BRACKET_PATHS = PATHS + ('a', 'zz.c', '9.c', 'Q.c', 'e', 'b1', 'xyz', '')
+for pattern in BRACKET_PATTERNS:
+  compiled = Compiled(DFA(NFA.fnmatch(pattern)))
+  compiled.optimize()
+  for path in BRACKET_PATHS:
+    assert compiled(path) == fnmatch.fnmatch(path, pattern)
+    assert compiled.match_buffer(path) == fnmatch.fnmatch(path, pattern)
+
+# every optimization level, and a hand picked list of passes, give the same
+# results
+from compiler import PASSES
+from llvm.passes import PASS_PROMOTE_MEMORY_TO_REGISTER
+for pattern in PATTERNS:
+  for level in PASSES:
+    compiled = Compiled(DFA(NFA.fnmatch(pattern)))
+    compiled.optimize(level)
+    for path in PATHS:
+      assert compiled(path) == fnmatch.fnmatch(path, pattern)
+  compiled = Compiled(DFA(NFA.fnmatch(pattern)))
+  compiled.optimize(passes=[PASS_PROMOTE_MEMORY_TO_REGISTER])
+  for path in PATHS:
+    assert compiled(path) == fnmatch.fnmatch(path, pattern)
+
+# the process wide cache only compiles each pattern once
+import cache
+for pattern in PATTERNS:
+  compiled = cache.compile(pattern)
+  assert cache.compile(pattern) is compiled
+  for path in PATHS:
+    assert compiled(path) == fnmatch.fnmatch(path, pattern)
+del compiled
+
+# evicted patterns are removed from the execution engine
+import gc
+gc.collect()
+modules = Compiled.modules
+small = cache.PatternCache(size=2)
+for pattern in PATTERNS + BRACKET_PATTERNS:
+  small.compile(pattern)
+gc.collect()
+assert Compiled.modules == modules + 2
+small.clear()
+gc.collect()
+assert Compiled.modules == modules
+# and can be disposed of explicitly
+compiled = Compiled(DFA(NFA.fnmatch('*.c')))
+assert compiled('x.c') and Compiled.modules == modules + 1
+compiled.dispose()
+compiled.dispose()
+assert Compiled.modules == modules
+try:
+  compiled('x.c')
+except ValueError:
+  pass
+else:
+  assert False, 'disposed pattern was called'
+
+# a second cache sharing a directory with the first loads its bitcode
+from tempfile import mkdtemp
+from shutil import rmtree
+directory = mkdtemp()
+try:
+  first = cache.PatternCache(directory=directory)
+  second = cache.PatternCache(directory=directory)
+  for pattern in PATTERNS:
+    first.compile(pattern)
+    compiled = second.compile(pattern)
+    for path in PATHS:
+      assert compiled(path) == fnmatch.fnmatch(path, pattern)
+  # files that can't be loaded are recompiled and replaced
+  third = cache.PatternCache(directory=directory)
+  path = third.disk.path('*.txt', 2)
+  third.disk.write(path, 'not bitcode')
+  compiled = third.compile('*.txt')
+  assert compiled('README.txt') and not compiled('README')
+  assert third.disk.read(path) != 'not bitcode'
+  assert cache.PatternCache(directory=directory).disk.load('*.txt', 2)
+finally:
+  rmtree(directory)
+
+# tiered matchers switch to native code
+from tiered import Matcher
+for pattern in BRACKET_PATTERNS:
+  matcher = Matcher(pattern, threshold=2, background=False)
+  for path in BRACKET_PATHS:
+    assert matcher(path) == fnmatch.fnmatch(path, pattern)
+  assert matcher.stats()['engine'] == 'compiled'
+
+# compile and match from several threads at once
+from threading import Thread
+errors = []
+def worker(pattern):
+  try:
+    compiled = cache.compile(pattern)
+    for x in range(100):
+      expected = [fnmatch.fnmatch(path, pattern) for path in BRACKET_PATHS]
+      assert [compiled(path) for path in BRACKET_PATHS] == expected
+      assert compiled.match_many(BRACKET_PATHS) == bytearray(expected)
+  except Exception, e:
+    errors.append(e)
+threads = [Thread(target=worker, args=(pattern,)) 
+    for pattern in BRACKET_PATTERNS + PATTERNS]
+for thread in threads:
+  thread.start()
+for thread in threads:
+  thread.join()
+assert not errors
+
+# DFAs can be built on several threads at once
+import sys
+from dfa import LazyDFA
+def build(pattern):
+  try:
+    for x in range(100):
+      dfa = DFA(NFA.fnmatch(pattern), minimize=True)
+      lazy = LazyDFA(NFA.fnmatch(pattern))
+      for path in BRACKET_PATHS:
+        expected = fnmatch.fnmatch(path, pattern)
+        assert dfa(path) == expected and lazy(path) == expected
+  except Exception, e:
+    errors.append(e)
+interval = sys.getcheckinterval()
+sys.setcheckinterval(1)
+try:
+  threads = [Thread(target=build, args=(pattern,))
+      for pattern in BRACKET_PATTERNS + PATTERNS]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+finally:
+  sys.setcheckinterval(interval)
+assert not errors
+
+# native search loops find the same matches as the pure Python ones
+from search import Searcher
+text = 'README.txt test.c x.h README\nfoo.c\0bar.h'
+text_file = TemporaryFile()
+text_file.write(text)
+text_file.flush()
+mapped_text = mmap(text_file.fileno(), 0, access=ACCESS_READ)
+for pattern in PATTERNS + BRACKET_PATTERNS:
+  searcher = Searcher(pattern)
+  assert searcher.strategy() == 'compiled'
+  expected = list(Searcher(pattern, compile=False).finditer(text))
+  assert list(searcher.finditer(text)) == expected
+  assert list(searcher.finditer(bytearray(text))) == expected
+  assert list(searcher.finditer(mapped_text)) == expected
+  assert list(searcher.finditer(memoryview(text))) == expected
+  assert list(searcher.finditer(text, 5, 20)) == \
+      list(Searcher(pattern, compile=False).finditer(text, 5, 20))
+  # unoptimized scan loops find the same matches
+  assert list(Searcher(pattern, level=0).finditer(text)) == expected
+
+# compile the patterns as a set
+from patternset import PatternSet
+patternset = PatternSet(PATTERNS)
+compiled_mask = patternset.compile()
+compiled_first = patternset.compile(first=True)
+for compiled in (compiled_mask, compiled_first):
+  compiled.optimize()
+assert compiled_first.match_many(PATHS) == [compiled_first(path) 
+    for path in PATHS]
+assert compiled_mask.match_many(PATHS) == [compiled_mask(path) 
+    for path in PATHS]
+assert compiled_first.match_many([]) == []
+assert compiled_mask.match_many([]) == []
+for path in PATHS:
+  expected = [id for id, pattern in enumerate(PATTERNS) 
+      if fnmatch.fnmatch(path, pattern)]
+  assert compiled_mask(path) == sum([1 << id for id in expected])
+  assert compiled_first(path) == (expected[0] if expected else -1)
+
+# bitmasks aren't limited to 64 patterns
+MANY_PATTERNS = ['*%d' % n for n in range(199)] + ['*']
+MANY_PATHS = ('x1', 'x10', 'x198', 'x198\0', 'x', '') + PATHS
+compiled_mask = PatternSet(MANY_PATTERNS).compile()
+compiled_mask.optimize()
+expected = [sum([1 << id for id, pattern in enumerate(MANY_PATTERNS)
+    if fnmatch.fnmatchcase(path, pattern)]) for path in MANY_PATHS]
+assert expected[2] >> 198 == 3
+assert [compiled_mask(path) for path in MANY_PATHS if '\0' not in path] == \
+    [mask for path, mask in zip(MANY_PATHS, expected) if '\0' not in path]
+assert [compiled_mask.match_buffer(path) for path in MANY_PATHS] == expected
+assert [compiled_mask.run(path) for path in MANY_PATHS 
+    if '\0' not in path] == \
+    [mask for path, mask in zip(MANY_PATHS, expected) if '\0' not in path]
+assert compiled_mask.match_many(MANY_PATHS) == expected
+
+# path-aware patterns compile to the same answers as the interpreter
+FLAGGED_PATHS = ('x.c', 'src/x.c', 'src/lib/x.c', '.x.c', 'src/.x.c', 
+    '.git/x.c')
+for pattern in ('*.c', '**/*.c', 'src/**', '*/*'):
+  for flags in ({'pathname': True}, {'period': True}, 
+      {'pathname': True, 'period': True}):
+    nfa = NFA.fnmatch(pattern, **flags)
+    compiled = cache.compile(pattern, **flags)
+    for path in FLAGGED_PATHS:
+      assert compiled(path) == nfa(path)
+
+# case insensitive patterns match the same as lower casing everything
+for pattern in PATTERNS + BRACKET_PATTERNS:
+  compiled = cache.compile(pattern, casefold=True)
+  for path in PATHS + tuple([path.upper() for path in PATHS]):
+    assert compiled(path) == \
+        fnmatch.fnmatchcase(path.lower(), pattern.lower())
+
+# feeding paths in chunks to native code carries the state between calls
+from incremental import StreamMatcher
+for pattern in PATTERNS + BRACKET_PATTERNS:
+  matcher = StreamMatcher(pattern)
+  assert matcher.strategy() == 'compiled'
+  for path in PATHS + ('x\0y.c', ''):
+    expected = fnmatch.fnmatchcase(path, pattern)
+    for split in range(len(path) + 1):
+      matcher.reset()
+      matcher.feed(path[:split])
+      matcher.feed(bytearray(path[split:]))
+      assert matcher.result() == expected
+      matcher.reset()
+      matcher.feed(memoryview(path)[:split])
+      matcher.feed(buffer(path, split))
+      assert matcher.result() == expected
+  unoptimized = StreamMatcher(pattern, level=0)
+  for path in PATHS:
+    unoptimized.reset()
+    unoptimized.feed(path)
+    assert unoptimized.result() == fnmatch.fnmatchcase(path, pattern)
+# once there's no transition the state stays dead
+matcher = StreamMatcher('a*')
+matcher.feed('b')
+assert matcher.state == -1
+matcher.feed('a')
+assert matcher.state == -1 and not matcher.result()
+
+# lines of read-only mmaps are filtered in place
+from filters import filter_lines
+for pattern in PATTERNS + BRACKET_PATTERNS:
+  assert list(filter_lines(pattern, mapped)) == \
+      [path for path in PATHS if fnmatch.fnmatch(path, pattern)]
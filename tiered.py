@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+'''a matcher that picks its execution strategy as a pattern gets used'''
+
+from threading import Lock, Thread
+
+from nfa import NFA
+from dfa import LazyDFA
+from shiftand import ShiftAnd
+import fastpath
+
+
+class Matcher:
+  '''matches paths against a pattern. patterns with a fast path use it, other
+  patterns start out interpreted, which costs nothing to set up, and are
+  compiled to native code once they've been used @threshold times. 
+  compilation happens on a background thread if @background is set, and the
+  matcher switches over to the native code once it's ready. a matcher can be
+  shared between threads'''
+  # the number of calls before a pattern is compiled
+  threshold = 1000
+
+  def __init__(self, pattern, threshold=None, background=True, compile=None):
+    '''@compile is a function that returns a compiled pattern, by default
+    patterns are compiled through the process wide cache'''
+    self.pattern = pattern
+    if threshold is not None:
+      self.threshold = threshold
+    self.background = background
+    if compile is None:
+      import cache
+      compile = cache.compile
+    self.compile = compile
+
+    nfa = NFA.fnmatch(pattern)
+    self.engine = fastpath.analyze(nfa)
+    if self.engine is not None:
+      # nothing beats the fast path
+      self.tier = 'fast'
+    else:
+      try:
+        self.engine = ShiftAnd(nfa)
+      except ValueError:
+        self.engine = LazyDFA(nfa)
+      self.tier = 'interpreted'
+    # the number of calls made to each tier
+    self.calls = {self.tier: 0}
+    # set once the pattern starts being compiled
+    self.promoted = False
+    # guards the tier, engine and counters
+    self.lock = Lock()
+    # the thread compiling the pattern, if it's being compiled in the 
+    # background
+    self.thread = None
+    # the exception raised compiling the pattern, if it failed
+    self.error = None
+
+  def __call__(self, path):
+    '''evaluate a string against the pattern, return True or False'''
+    with self.lock:
+      engine = self.engine
+      calls = self.calls[self.tier] + 1
+      self.calls[self.tier] = calls
+    if calls >= self.threshold and not self.promoted:
+      self.promote()
+    return engine(path)
+
+  def promote(self):
+    '''start compiling the pattern'''
+    with self.lock:
+      if self.promoted or self.tier != 'interpreted':
+        return
+      self.promoted = True
+    if self.background:
+      self.thread = Thread(target=self.__compile, 
+          name='compile %s' % self.pattern)
+      self.thread.setDaemon(True)
+      self.thread.start()
+    else:
+      self.__compile()
+
+  def __compile(self):
+    '''compile the pattern and switch over to the native code'''
+    try:
+      compiled = self.compile(self.pattern)
+    except Exception, e:
+      # carry on interpreting, for example when LLVM isn't available
+      self.error = e
+      return
+    with self.lock:
+      self.calls['compiled'] = 0
+      self.engine = compiled
+      self.tier = 'compiled'
+
+  def strategy(self):
+    '''how paths are matched right now'''
+    return self.tier
+
+  def stats(self):
+    '''a dict describing the matcher's tiers'''
+    with self.lock:
+      return {
+        'tier': self.tier,
+        'engine': self.engine.strategy(),
+        'threshold': self.threshold,
+        'calls': dict(self.calls),
+        'error': self.error,
+      }
+
+
+def test_Matcher():
+  from fnmatch import fnmatchcase
+  from dfa import DFA
+  from table import Table
+  compiles = []
+  def compile(pattern):
+    compiles.append(pattern)
+    return Table(DFA(NFA.fnmatch(pattern)))
+  paths = ('test.c', 'test.h', 'README.txt', 'README', '')
+
+  # fast paths are never compiled
+  matcher = Matcher('*.txt', threshold=2, compile=compile)
+  for path in paths:
+    assert matcher(path) == fnmatchcase(path, '*.txt')
+  assert matcher.strategy() == 'fast' and not compiles
+  assert matcher.stats()['calls'] == {'fast': len(paths)}
+
+  # others are compiled once they cross the threshold
+  matcher = Matcher('*.[ch]', threshold=3, background=False, compile=compile)
+  assert matcher.stats()['engine'] == 'shift-and'
+  for path in paths:
+    assert matcher(path) == fnmatchcase(path, '*.[ch]')
+  assert compiles == ['*.[ch]']
+  assert matcher.stats() == {'tier': 'compiled', 'engine': 'table', 
+      'threshold': 3, 'calls': {'interpreted': 3, 'compiled': 2}, 
+      'error': None}
+
+  # in the background
+  matcher = Matcher('?*.[ch]', threshold=1, compile=compile)
+  assert matcher('test.c')
+  matcher.thread.join()
+  assert matcher.strategy() == 'compiled'
+  assert matcher('test.h') and not matcher('README')
+
+  # failing to compile leaves the pattern interpreted
+  def fail(pattern):
+    raise ImportError('no llvm')
+  matcher = Matcher('*.[ch]', threshold=1, background=False, compile=fail)
+  assert matcher('test.c') and matcher('test.h')
+  assert matcher.strategy() == 'interpreted'
+  assert isinstance(matcher.stats()['error'], ImportError)
+
+  # calls from several threads are all counted
+  import sys
+  from threading import Thread
+  matcher = Matcher('*.[ch]', threshold=10**9)
+  def work():
+    for x in range(2000):
+      assert matcher('test.c') and not matcher('README')
+  interval = sys.getcheckinterval()
+  sys.setcheckinterval(1)
+  try:
+    threads = [Thread(target=work) for x in range(8)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+  finally:
+    sys.setcheckinterval(interval)
+  assert matcher.stats()['calls'] == {'interpreted': 8 * 2 * 2000}
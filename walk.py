@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+'''walking directory trees for the paths that match a pattern, without
+reading directories that nothing matching the pattern can be in'''
+
+import os
+
+from nfa import NFA
+from dfa import DFA
+
+
+def walk(pattern, top='.', listdir=os.listdir, **flags):
+  '''yield the paths under @top, relative to it, that match @pattern.
+  directories are matched against the pattern as they're entered, so
+  directories that no matching path can be under aren't read at all.
+  directories are read with @listdir. @flags are passed to NFA.fnmatch,
+  pathname defaults to True. like os.walk() symbolic links to directories
+  aren't followed'''
+  flags.setdefault('pathname', True)
+  dfa = DFA(NFA.fnmatch(pattern, **flags), minimize=True)
+  work = [('', dfa.cursor())]
+  while work:
+    prefix, cursor = work.pop()
+    try:
+      names = listdir(os.path.join(top, prefix))
+    except OSError:
+      continue
+    for name in sorted(names, reverse=True):
+      path = prefix + name
+      position = cursor.feed(name)
+      if position.match():
+        yield path
+      # only look at whether it's a directory if something below it could
+      # match
+      below = position.feed('/')
+      if below.dead():
+        continue
+      full = os.path.join(top, path)
+      if os.path.isdir(full) and not os.path.islink(full):
+        work.append((path + '/', below))
+
+
+def test_walk():
+  from tempfile import mkdtemp
+  from shutil import rmtree
+  top = mkdtemp()
+  try:
+    for path in ('README', 'src/x.py', 'src/lib/test_a.py', 'src/lib/a.py',
+        'src/lib/sub/test_b.py', 'src/bin/test_c.py', 'doc/test_d.py'):
+      path = os.path.join(top, path)
+      if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+      open(path, 'w').close()
+
+    # count the directories that get read
+    listed = []
+    def listdir(path):
+      listed.append(os.path.relpath(path, top))
+      return os.listdir(path)
+    assert sorted(walk('src/*/test_*.py', top, listdir)) == \
+        ['src/bin/test_c.py', 'src/lib/test_a.py']
+    # doc and src/lib/sub were pruned
+    assert sorted(listed) == ['.', 'src', 'src/bin', 'src/lib']
+    del listed[:]
+    assert sorted(walk('**/test_*.py', top, listdir)) == ['doc/test_d.py',
+        'src/bin/test_c.py', 'src/lib/sub/test_b.py', 'src/lib/test_a.py']
+    assert len(listed) == 6
+    del listed[:]
+    assert list(walk('README', top, listdir)) == ['README']
+    assert listed == ['.']
+    assert sorted(walk('src/*', top)) == ['src/bin', 'src/lib', 'src/x.py']
+    assert list(walk('missing/*', top)) == []
+  finally:
+    rmtree(top)